@@ -0,0 +1,187 @@
+import asyncio
+import json
+import random
+import re
+import zlib
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+_ID_PATTERN = re.compile(r"(?:ID:|'id':|\"id\":)\s*(\d+)|^(\d+)\|", re.M)
+
+
+def _usage(prompt: str, completion: str) -> SimpleNamespace:
+    prompt_tokens = max(1, len(prompt) // 4)
+    completion_tokens = max(1, len(completion) // 4)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens
+    )
+
+
+class FakeEmbeddings:
+    """Deterministic embeddings: the sum of fixed random vectors for each token, so texts that
+    share tags land close together, as they would with a real model."""
+
+    def __init__(self, backend: "FakeAsyncOpenAI"):
+        self.backend = backend
+        self._token_vectors: Dict[str, np.ndarray] = {}
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.backend.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()) or [""]:
+            token_vector = self._token_vectors.get(token)
+            if token_vector is None:
+                rng = np.random.default_rng(zlib.crc32(token.encode("utf-8")))
+                token_vector = rng.standard_normal(self.backend.dim).astype(np.float32)
+                self._token_vectors[token] = token_vector
+            vector += token_vector
+        vector /= np.linalg.norm(vector) or 1.0
+        return vector.tolist()
+
+    async def create(self, model: str, input: Any, **kwargs: Any) -> SimpleNamespace:
+        texts = [input] if isinstance(input, str) else list(input)
+        await asyncio.sleep(self.backend.embedding_latency_ms / 1000.0)
+        self.backend.calls["embeddings"] += 1
+        data = [SimpleNamespace(index=i, embedding=self.embed(t)) for i, t in enumerate(texts)]
+        return SimpleNamespace(data=data, model=model, usage=_usage(" ".join(texts), ""))
+
+
+class FakeChatCompletions:
+    def __init__(self, backend: "FakeAsyncOpenAI"):
+        self.backend = backend
+
+    def respond(self, system: str, user: str, max_tokens: int, seed: Optional[int] = None) -> str:
+        if "tag prediction assistant" in system:
+            tags = json.loads(user.split("Available Tags:\n", 1)[1])
+            rng = random.Random(zlib.crc32(f"{user}{seed}".encode("utf-8")))
+            return json.dumps(rng.sample(tags, min(len(tags), rng.randint(5, 10))))
+        if "story generator assistant" in system:
+            count = int(re.search(r"exactly (\d+)", system).group(1))
+            start = re.search(r"starting at ID (\d+)", system)
+            return json.dumps(synthetic_stories(
+                count,
+                seed=zlib.crc32((system + user).encode("utf-8")),
+                start_id=int(start.group(1)) if start else 300000
+            ))
+        if "prompt optimization assistant" in system:
+            last = user.split("Last Prompt:\n", 1)[1].split("\n\n", 1)[0]
+            return last + " Prefer stories whose tags overlap the user's tags."
+        ids = list(dict.fromkeys(int(a or b) for a, b in _ID_PATTERN.findall(user)))
+        return json.dumps(ids[:10])
+
+    async def create(self, model: str, messages: List[Dict[str, str]], **kwargs: Any) -> Any:
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        user = next((m["content"] for m in messages if m["role"] == "user"), "")
+        content = self.respond(system, user, kwargs.get("max_tokens", 200), kwargs.get("seed"))
+        if kwargs.get("stream"):
+            await asyncio.sleep(self.backend.chat_latency_ms / 1000.0)
+            self.backend.calls["chat"] += 1
+            usage = None
+            if (kwargs.get("stream_options") or {}).get("include_usage"):
+                usage = _usage(system + user, content)
+            return FakeStream(content, self.backend.ms_per_output_token, usage)
+        await asyncio.sleep(
+            self.backend.chat_latency_ms / 1000.0
+            + self.backend.ms_per_output_token * (len(content) // 4) / 1000.0
+        )
+        self.backend.calls["chat"] += 1
+        # With n > 1 every extra choice gets a marker so candidates differ, as sampled ones would.
+        contents = [content] + [f"{content} (variant {i})" for i in range(1, kwargs.get("n") or 1)]
+        choices = [
+            SimpleNamespace(index=i, message=SimpleNamespace(role="assistant", content=c), finish_reason="stop")
+            for i, c in enumerate(contents)
+        ]
+        return SimpleNamespace(choices=choices, model=model, usage=_usage(system + user, "".join(contents)))
+
+
+class FakeStream:
+    """Async iterator of chat chunks, about one token (4 characters) per chunk, then a usage
+    chunk if one was requested."""
+
+    def __init__(self, content: str, ms_per_token: float, usage: Optional[SimpleNamespace] = None):
+        self.pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+        self.ms_per_token = ms_per_token
+        self.usage = usage
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for piece in self.pieces:
+            if self.closed:
+                return
+            await asyncio.sleep(self.ms_per_token / 1000.0)
+            delta = SimpleNamespace(role="assistant", content=piece)
+            yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)], usage=None)
+        if self.usage is not None and not self.closed:
+            yield SimpleNamespace(choices=[], usage=self.usage)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAsyncOpenAI:
+    """Stand-in for AsyncOpenAI with configurable latency; install with OpenAiAgent.use_client."""
+
+    def __init__(
+        self,
+        dim: int = 1536,
+        chat_latency_ms: float = 0.0,
+        embedding_latency_ms: float = 0.0,
+        ms_per_output_token: float = 0.0
+    ):
+        self.dim = dim
+        self.chat_latency_ms = chat_latency_ms
+        self.embedding_latency_ms = embedding_latency_ms
+        self.ms_per_output_token = ms_per_output_token
+        self.calls = {"chat": 0, "embeddings": 0}
+        self.chat = SimpleNamespace(completions=FakeChatCompletions(self))
+        self.embeddings = FakeEmbeddings(self)
+
+    async def close(self):
+        pass
+
+
+TAG_VOCABULARY = [
+    "isekai", "romance", "slow burn", "enemies to lovers", "found family", "reverse harem",
+    "naruto", "dragon ball", "jujutsu kaisen", "demon slayer", "one piece", "my hero academia",
+    "crossover", "rivalry", "tournament", "betrayal", "redemption", "loyalty", "survival",
+    "comedy", "horror", "mystery", "magic", "academy", "royalty", "villain", "protector",
+    "time travel", "reincarnation", "forbidden love", "underdog", "power fantasy", "curses",
+    "cafe", "school life", "dystopia", "space opera", "heist", "detective", "vampires",
+]
+
+
+def synthetic_stories(count: int, seed: int = 0, start_id: int = 300000) -> List[dict]:
+    rng = random.Random(seed)
+    stories = []
+    for i in range(count):
+        tags = rng.sample(TAG_VOCABULARY, rng.randint(3, 7))
+        stories.append({
+            "id": start_id + i,
+            "title": f"Story {start_id + i}: {tags[0].title()} and {tags[1].title()}",
+            "intro": f"A {tags[0]} tale where {tags[-1]} decides everything.",
+            "tags": tags,
+        })
+    return stories
+
+
+def synthetic_users(count: int, seed: int = 0) -> List[dict]:
+    rng = random.Random(seed)
+    return [{"id": i + 1, "tags": rng.sample(TAG_VOCABULARY, rng.randint(10, 25))} for i in range(count)]
+
+
+def fake_redis_clients():
+    try:
+        import fakeredis
+    except ImportError as e:
+        raise SystemExit("The benchmark needs fakeredis: pip install fakeredis") from e
+    server = fakeredis.FakeServer()
+    return (
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=False),
+    )
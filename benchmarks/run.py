@@ -0,0 +1,275 @@
+"""Offline benchmark for the recommendation pipeline.
+
+Runs every stage against a deterministic fake OpenAI backend and fakeredis, so results
+are reproducible without network access:
+
+    python -m benchmarks.run --sizes 100,1000,10000 --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --sizes 100,1000,10000 --compare benchmarks/baseline.json
+    python -m benchmarks.run --sizes 100000 --pipeline-max-size 0 --compression --ann
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from benchmarks.fakes import FakeAsyncOpenAI, TAG_VOCABULARY, fake_redis_clients, synthetic_users
+from src.ai_agents.open_ai import OpenAiAgent
+from src.cache.redis import use_redis_clients
+from src.retrieval.ivf import ANN_MIN_POOL_SIZE, ANN_N_PROBE, IvfFlatIndex, recall_at_k
+from src.retrieval.quantized import compression_report
+from src.retrieval.scoring import EmbeddingMatrix
+from src.retrieval.sharded import ShardedScorer, shutdown_executor
+
+
+async def measure(
+    stage: str,
+    size: int,
+    repeats: int,
+    run: Callable[[int], Awaitable[Any]],
+    items_per_run: int = 1
+) -> Dict[str, Any]:
+    latencies = []
+    for i in range(repeats):
+        started = time.perf_counter()
+        await run(i)
+        latencies.append(time.perf_counter() - started)
+
+    # Memory is sampled on a separate run so tracemalloc overhead does not skew latency.
+    tracemalloc.start()
+    await run(repeats)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "stage": stage,
+        "size": size,
+        "repeats": repeats,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "mean_ms": float(latencies_ms.mean()),
+        "throughput_per_s": items_per_run * repeats / (sum(latencies) or 1e-9),
+        "peak_mem_mb": peak / 2**20,
+    }
+
+
+async def bench_scan(size: int, dim: int, repeats: int, workers: int = 0) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(size)
+    matrix = EmbeddingMatrix(np.arange(size), rng.standard_normal((size, dim), dtype=np.float32), copy=False)
+    queries = rng.standard_normal((repeats + 1, dim), dtype=np.float32)
+
+    async def single(i: int):
+        matrix.top_k(queries[i], 60)
+
+    async def batched(i: int):
+        matrix.top_k_batch(queries[:16], 60)
+
+    results = [
+        await measure("prefilter_scan", size, repeats, single),
+        await measure("prefilter_scan_batch16", size, max(1, repeats // 4), batched, items_per_run=16),
+    ]
+    if workers > 0:
+        scorer = ShardedScorer(matrix, workers)
+        await scorer.warm()
+
+        async def sharded(i: int):
+            # 16 independent queries in flight at once, as concurrent requests would be.
+            await asyncio.gather(*(scorer.search(q, 60) for q in queries[:16]))
+
+        results.append(await measure(
+            f"prefilter_sharded{workers}x16", size, max(1, repeats // 4), sharded, items_per_run=16
+        ))
+        scorer.close()
+    for r in results:
+        r["matrix_mb"] = matrix.vectors.nbytes / 2**20
+    return results
+
+
+def clustered_embeddings(size: int, dim: int, repeats: int, rank: int = 64) -> Tuple[EmbeddingMatrix, np.ndarray]:
+    # Real embeddings concentrate in a low-dimensional subspace; isotropic noise alone would
+    # make any projection or clustering look useless, so vectors are a low-rank signal plus noise.
+    rng = np.random.default_rng(size)
+    basis = rng.standard_normal((rank, dim), dtype=np.float32)
+    vectors = rng.standard_normal((size, rank), dtype=np.float32) @ basis
+    vectors += np.sqrt(rank) * rng.standard_normal((size, dim), dtype=np.float32)
+    matrix = EmbeddingMatrix(np.arange(size), vectors, copy=False)
+    queries = rng.standard_normal((repeats, rank), dtype=np.float32) @ basis
+    return matrix, queries
+
+
+def bench_compression(size: int, dim: int, repeats: int) -> List[Dict[str, Any]]:
+    rows = compression_report(*clustered_embeddings(size, dim, repeats), k=60)
+    for r in rows:
+        r["size"] = size
+    return rows
+
+
+def bench_ann(size: int, dim: int, repeats: int, n_probe: int = ANN_N_PROBE) -> Dict[str, Any]:
+    # The IVF index the prefilter switches to at ANN_MIN_POOL_SIZE, in the compression table's shape.
+    matrix, queries = clustered_embeddings(size, dim, repeats)
+    started = time.perf_counter()
+    index = IvfFlatIndex.train(matrix, n_probe=n_probe)
+    build_s = time.perf_counter() - started
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(query, 60)
+        timings.append(time.perf_counter() - started)
+    nbytes = index.centroids.nbytes + index.assignments.nbytes
+    return {
+        "mode": f"ivf/{n_probe}", "size": size, "bytes": nbytes,
+        "memory_ratio": nbytes / max(matrix.vectors.nbytes, 1),
+        "recall": recall_at_k(index, queries, 60), "p50_ms": float(np.median(timings) * 1000),
+        "build_s": build_s,
+    }
+
+
+def print_compression_table(rows: List[Dict[str, Any]]):
+    print(f"{'mode':<12}{'size':>9}{'MB':>10}{'memory':>9}{'recall@60':>11}{'p50 ms':>10}{'build s':>9}")
+    for r in rows:
+        print(f"{r['mode']:<12}{r['size']:>9}{r['bytes'] / 2**20:>10.1f}{r['memory_ratio']:>9.3f}"
+              f"{r['recall']:>11.3f}{r['p50_ms']:>10.2f}{r['build_s']:>9.2f}")
+
+
+async def bench_pipeline(size: int, repeats: int, redis_client) -> List[Dict[str, Any]]:
+    # Imported here so the fake client and fakeredis are installed before any agent runs.
+    from main import expand_story_pool, seed_stories
+    from src.ai_agents.evaluation import compute_ground_truth_top10
+    from src.ai_agents.recommend import prefilter_stories_with_embeddings, recommend_stories
+
+    results = []
+    pool: List[dict] = []
+
+    async def expand(i: int):
+        nonlocal pool
+        await redis_client.flushdb()
+        pool = await expand_story_pool(seed_stories, target_count=size)
+
+    results.append(await measure("expand_pool", size, 1, expand, items_per_run=size))
+
+    rng = random.Random(size)
+    tag_sets = [rng.sample(TAG_VOCABULARY, rng.randint(5, 10)) for _ in range(repeats + 1)]
+    users = synthetic_users(repeats + 1, seed=size)
+
+    async def prefilter(i: int):
+        await prefilter_stories_with_embeddings(tag_sets[i], pool, mode="dense")
+
+    async def prefilter_tags(i: int):
+        await prefilter_stories_with_embeddings(tag_sets[i], pool, mode="tags")
+
+    async def prefilter_hybrid(i: int):
+        await prefilter_stories_with_embeddings(tag_sets[i], pool, mode="hybrid")
+
+    async def recommend(i: int):
+        await recommend_stories("Return 10 story IDs from the pool.", tag_sets[i], pool)
+
+    async def ground_truth(i: int):
+        await compute_ground_truth_top10(users[i]["tags"], pool)
+
+    results.append(await measure("prefilter", size, repeats, prefilter))
+    results.append(await measure("prefilter_tags", size, repeats, prefilter_tags))
+    results.append(await measure("prefilter_hybrid", size, repeats, prefilter_hybrid))
+    results.append(await measure("recommend", size, repeats, recommend))
+    results.append(await measure("ground_truth", size, repeats, ground_truth))
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    previous = {(r["stage"], r["size"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        base = previous.get((r["stage"], r["size"]))
+        if base and r["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{r['stage']}@{r['size']}: p50 {r['p50_ms']:.2f}ms vs baseline {base['p50_ms']:.2f}ms"
+            )
+    return regressions
+
+
+def print_table(results: List[Dict[str, Any]]):
+    print(f"{'stage':<24}{'size':>9}{'p50 ms':>11}{'p95 ms':>11}{'items/s':>12}{'peak MB':>10}")
+    for r in results:
+        print(f"{r['stage']:<24}{r['size']:>9}{r['p50_ms']:>11.2f}{r['p95_ms']:>11.2f}"
+              f"{r['throughput_per_s']:>12.1f}{r['peak_mem_mb']:>10.1f}")
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    fake = FakeAsyncOpenAI(
+        dim=args.dim,
+        chat_latency_ms=args.chat_latency_ms,
+        embedding_latency_ms=args.embedding_latency_ms,
+        ms_per_output_token=args.ms_per_output_token
+    )
+    OpenAiAgent.use_client(fake)
+    redis_client, redis_binary = fake_redis_clients()
+    use_redis_clients(redis_client, redis_binary)
+
+    results = []
+    for size in args.sizes:
+        results.extend(await bench_scan(size, args.dim, args.repeats, args.scoring_workers))
+        if size <= args.pipeline_max_size:
+            results.extend(await bench_pipeline(size, args.repeats, redis_client))
+    shutdown_executor()
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")],
+                        default=[100, 1000, 10000, 100000],
+                        help="pool sizes to benchmark; 1000000 needs ~6 GB at --dim 1536")
+    parser.add_argument("--dim", type=int, default=1536, help="embedding dimension")
+    parser.add_argument("--repeats", type=int, default=20, help="timed runs per stage")
+    parser.add_argument("--pipeline-max-size", type=int, default=10000,
+                        help="largest pool run through the full Redis/LLM pipeline; larger sizes only run the scan")
+    parser.add_argument("--chat-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0)
+    parser.add_argument("--ms-per-output-token", type=float, default=0.0)
+    parser.add_argument("--scoring-workers", type=int, default=0,
+                        help="also time the scan sharded across this many worker processes")
+    parser.add_argument("--compression", action="store_true",
+                        help="also report recall@60, memory and latency of the compressed prefilters")
+    parser.add_argument("--ann", action="store_true",
+                        help=f"also report recall@60 of the IVF index for sizes >= ANN_MIN_POOL_SIZE ({ANN_MIN_POOL_SIZE})")
+    parser.add_argument("--ann-probe", type=int, default=ANN_N_PROBE,
+                        help="lists probed per query by --ann (defaults to ANN_N_PROBE)")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--save-baseline", help="write results as the new baseline to this path")
+    parser.add_argument("--compare", help="baseline JSON to check for p50 regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown vs baseline")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print_table(results)
+    if args.compression or args.ann:
+        rows = []
+        for size in args.sizes:
+            if args.compression:
+                rows.extend(bench_compression(size, args.dim, args.repeats))
+            if args.ann and size >= ANN_MIN_POOL_SIZE:
+                rows.append(bench_ann(size, args.dim, args.repeats, args.ann_probe))
+        print()
+        print_compression_table(rows)
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
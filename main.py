@@ -1,23 +1,27 @@
+import argparse
 import json
-import re
 import time
 import asyncio
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from src.data.user import users
 
 from dotenv import load_dotenv
 
-from src.ai_agents.prompt_optimizer import optimize_prompt
-from src.ai_agents.evaluation import evaluate_for_user
+from src.ai_agents.prompt_optimizer import propose_prompts
+from src.ai_agents.evaluation import ground_truth_top10, score_prompt, simulated_tag_samples
 from src.dataclass import Story
-from src.cache.redis import get_user_prompt, cache_user_prompt, get_story_pool, cache_story_pool, cache_story_embeddings
+from src.cache.redis import get_user_prompt, cache_user_prompt, get_story_pool, cache_story_pool, migrate_story_embeddings
+from src.cache.embedding_store import EMBEDDING_STORE_PATH, export_redis_embeddings, import_redis_embeddings
+from src.cache.pool_matrix import pool_matrix_cache
+from src.retrieval.sharded import shutdown_executor
 from src.ai_agents.open_ai import OpenAiAgent
-from src.ai_agents.recommend import generate_embedding
+from src.ai_agents.story_generator import generate_story_pool
+from src.ai_agents.story_pool import update_stories
+from src.deadline import DeadlineExceeded, deadline, remaining, stage_estimator, within_deadline
+from src.telemetry import telemetry
 
 load_dotenv()
 
-open_ai_agent = OpenAiAgent()
-
 seed_stories: List[Story] = [
     {
         "id": 217107,
@@ -52,47 +56,155 @@ seed_stories: List[Story] = [
 ]
 
 
+@telemetry.timed("expand_pool")
 async def expand_story_pool(seeds: List[Story], target_count: int = 130) -> List[Story]:
     cached_pool = await get_story_pool()
     if cached_pool:
         return cached_pool
     
-    seeds_text = json.dumps(seeds, ensure_ascii=False)
-    system_prompt = (
-        "You are a story generator assistant. Given a small list of Sekai-style stories "
-        "(each with id, title, intro, tags), expand this list so that the total number "
-        f"of stories is exactly {target_count}. Return EXACTLY a JSON array of story objects, "
-        "where each object has the fields: id (integer), title (string), intro (string), "
-        "and tags (array of strings). For speed and brevity, generate each new story "
-        "with an intro of no more than 30 English words. Ensure new IDs start higher than existing seed IDs. "
-        "Do NOT output any extra commentary—only the JSON array."
-    )
-    user_prompt = f"Seed Stories:\n{seeds_text}"
-
-    resp = open_ai_agent.client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        temperature=0.7,
-        max_tokens=5000
-    )
-    generated = resp.choices[0].message.content
-    match = re.search(r"\[.*\]", generated, re.S)
-    stories = json.loads(match.group(0))
+    stories = await generate_story_pool(seeds, target_count)
 
+    # Every story is embedded by now; publishing the pool bumps its version, so it goes last.
     await cache_story_pool(stories)
-    
-    for story in stories:
-        story_text = f"{story['title']} {story['intro']} {' '.join(story['tags'])}"
-        embedding = await generate_embedding(story_text)
-        await cache_story_embeddings(story['id'], embedding)
-    
+
     return stories
 
 
-async def main():
+def expected_round_seconds() -> Optional[float]:
+    # Proposal and scoring run back to back; unknown stages (first round) count as zero.
+    estimates = [stage_estimator.expected(stage) for stage in ("optimizer.propose", "optimizer.score")]
+    known = [e for e in estimates if e is not None]
+    return sum(known) if known else None
+
+
+async def optimize_for_user(
+    user: Dict[str, Any],
+    story_pool: List[Story],
+    max_seconds: float = 15,
+    candidates: int = 4,
+    beam_width: int = 2,
+    tag_samples: int = 3
+) -> Dict[str, Any]:
+    prompt_key = f"prompt:user{user['id']}"
+    initial_prompt = await get_user_prompt(prompt_key) or "Return 10 story IDs from the pool."
+    start_time = time.time()
+    # Beam entries are (mean precision, std across tag samples, prompt, per-sample details).
+    beam: List[Tuple[float, float, str, List[Dict[str, Any]]]] = []
+    evaluated = 0
+    iteration = 1
+
+    # Every LLM call below inherits the deadline and is cancelled when it passes.
+    with deadline(max_seconds):
+        try:
+            # Ground truth and tag samples stay fixed for the whole search, so candidates are scored on equal terms.
+            # story_pool is the cached pool (see expand_story_pool), so ground truth is keyed on the
+            # pool version like the server's, instead of hashing the whole pool per lookup.
+            gt_ids, samples = await within_deadline(asyncio.gather(
+                ground_truth_top10(user['tags']),
+                simulated_tag_samples(user['tags'], tag_samples)
+            ))
+            started = time.monotonic()
+            score, std, details = await within_deadline(score_prompt(initial_prompt, samples, gt_ids, story_pool))
+            stage_estimator.observe("optimizer.score", time.monotonic() - started)
+            print(f"[{user['id']}] Precision@10 = {score:.4f} ± {std:.4f} for prompt:\n{initial_prompt}\n")
+            beam.append((score, std, initial_prompt, details))
+            evaluated = 1
+
+            while True:
+                if beam[0][0] >= 0.8:
+                    print(f"[{user['id']}] Iteration:{iteration} Precision plateaued ({beam[0][0]:.4f}); stopping.\n")
+                    break
+                left = remaining()
+                expected = expected_round_seconds()
+                if left <= 0:
+                    print(f"[{user['id']}] Time limit reached ({time.time() - start_time:.1f}s). Stopping optimization.")
+                    break
+                if expected is not None and expected > left:
+                    telemetry.incr("optimizer_rounds_skipped_total")
+                    print(f"[{user['id']}] Next round needs ~{expected:.1f}s but only {left:.1f}s remain; stopping.")
+                    break
+                iteration += 1
+
+                # Every beam entry proposes its share of candidates; all of them are scored concurrently.
+                started = time.monotonic()
+                per_entry = -(-candidates // len(beam))
+                proposals = await within_deadline(asyncio.gather(*(
+                    propose_prompts(prompt, score, [d for d in details if d["precision"] < 1.0][:3], per_entry)
+                    for score, _, prompt, details in beam
+                )))
+                stage_estimator.observe("optimizer.propose", time.monotonic() - started)
+                known = {entry[2] for entry in beam}
+                new_prompts = [p for p in dict.fromkeys(p for group in proposals for p in group) if p not in known]
+                if not new_prompts:
+                    continue
+
+                # Candidates that finish before the deadline are kept; only the stragglers are cancelled.
+                started = time.monotonic()
+                tasks = [asyncio.ensure_future(score_prompt(p, samples, gt_ids, story_pool)) for p in new_prompts]
+                done, pending = await asyncio.wait(tasks, timeout=max(remaining(), 0))
+                expired = bool(pending)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                if not pending:
+                    stage_estimator.observe("optimizer.score", time.monotonic() - started)
+                # A failed candidate is dropped; the ones that finished still reach the beam.
+                scored = []
+                for p, task in zip(new_prompts, tasks):
+                    if task not in done:
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        scored.append((p, task.result()))
+                        continue
+                    telemetry.incr("optimizer_candidates_failed_total", error=type(error).__name__)
+                    if isinstance(error, DeadlineExceeded):
+                        expired = True
+                    else:
+                        print(f"[{user['id']}] Candidate failed ({type(error).__name__}: {error}); skipping it.")
+                evaluated += len(scored)
+                if scored:
+                    round_scores = [s for _, (s, _, _) in scored]
+                    round_mean = sum(round_scores) / len(round_scores)
+                    round_std = (sum((s - round_mean) ** 2 for s in round_scores) / len(round_scores)) ** 0.5
+                    print(f"[{user['id']}] Round {iteration}: {len(scored)}/{len(new_prompts)} candidates, "
+                          f"best {max(round_scores):.4f}, mean {round_mean:.4f} ± {round_std:.4f}\n")
+
+                    # Ties keep the lower-variance prompt, then the incumbent.
+                    previous_best = beam[0][2]
+                    beam = sorted(
+                        beam + [(s, sd, p, d) for p, (s, sd, d) in scored],
+                        key=lambda entry: (-entry[0], entry[1])
+                    )[:beam_width]
+                    if beam[0][2] != previous_best:
+                        await cache_user_prompt(prompt_key, beam[0][2])
+                if expired:
+                    raise DeadlineExceeded()
+        except DeadlineExceeded:
+            print(f"[{user['id']}] Time limit reached ({time.time() - start_time:.1f}s) mid-round; "
+                  "keeping the best prompt so far.")
+
+    if not beam:
+        return {
+            "user_id": user['id'], "prompt": initial_prompt, "score": 0.0, "score_std": 0.0,
+            "iterations": 0, "candidates_evaluated": 0, "elapsed": time.time() - start_time,
+        }
+    best_score, best_std, best_prompt, _ = beam[0]
+    await cache_user_prompt(prompt_key, best_prompt)
+    return {
+        "user_id": user['id'],
+        "prompt": best_prompt,
+        "score": best_score,
+        "score_std": best_std,
+        "iterations": iteration,
+        "candidates_evaluated": evaluated,
+        "elapsed": time.time() - start_time,
+    }
+
+
+async def main(watch_pool: bool = False):
+    if watch_pool:
+        pool_matrix_cache.start_listener()
     print("Expanding seed stories to ~100 with GPT-4...")
     story_pool = await expand_story_pool(seed_stories, target_count=30)
     max_seconds= 15
@@ -100,44 +212,161 @@ async def main():
     test_users = users
     user = test_users[3]
 
-    last_prompt = await get_user_prompt(f"prompt:user{user['id']}")
-    last_prompt = last_prompt if last_prompt else "Return 10 story IDs from the pool."
-
-    scores = []
-    start_time = time.time()
-    iteration = 1
-
-    while True:
-        elapsed = time.time() - start_time
-        if elapsed > max_seconds:
-                await cache_user_prompt(f"prompt:user{user['id']}", last_prompt)
-                print(f"[{user['id']}] Time limit reached ({elapsed:.1f}s). Stopping optimization.")
-                break
-        print(f"Using prompt:\n{last_prompt}\n")
-
-        failures: List[Dict[str, Any]] = []
-        
-        score, detail = await evaluate_for_user(user['tags'], last_prompt, story_pool)
-        print(f"Precision@10 = {score:.2f}")
-        scores.append(score)
-        failures.append(detail)
-
-        print(f"\n Precision@10 = {score:.4f}\n")
-
-        if score >= 0.8:
-            print(f"Iteration:{iteration} Precision plateaued (Δ={score:.4f}); stopping.\n")
-            break
-
-        print("Calling Prompt-Optimizer to generate new prompt...\n")
-        iteration += 1
-        new_prompt = optimize_prompt(last_prompt, score, failures)
-        last_prompt = new_prompt
-
-    await cache_user_prompt(f"prompt:user{user['id']}", last_prompt)
+    result = await optimize_for_user(user, story_pool, max_seconds)
     print("Final prompt:")
-    print(last_prompt)
+    print(result["prompt"])
     print("Loop finished.")
+    await OpenAiAgent.aclose()
+
+
+def load_users(users_file: Optional[str]) -> List[Dict[str, Any]]:
+    if not users_file:
+        return users
+    with open(users_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def optimize_all_users(
+    user_list: List[Dict[str, Any]],
+    max_seconds: float,
+    max_llm_concurrency: int,
+    max_users_in_flight: int,
+    candidates: int = 4,
+    beam_width: int = 2,
+    tag_samples: int = 3
+) -> List[Dict[str, Any]]:
+    # LLM calls from every user share one global cap; each user's time budget starts when
+    # that user is admitted, so queued users are not charged for waiting.
+    OpenAiAgent.set_max_concurrency(max_llm_concurrency)
+    story_pool = await expand_story_pool(seed_stories, target_count=30)
+    admission = asyncio.Semaphore(max_users_in_flight)
+
+    async def run(user: Dict[str, Any]) -> Dict[str, Any]:
+        async with admission:
+            try:
+                return await optimize_for_user(user, story_pool, max_seconds, candidates, beam_width, tag_samples)
+            except Exception as e:
+                print(f"[{user['id']}] Optimization failed: {e!r}")
+                return {"user_id": user['id'], "prompt": None, "score": 0.0, "score_std": 0.0,
+                        "iterations": 0, "candidates_evaluated": 0, "elapsed": 0.0, "error": repr(e)}
+
+    started = time.time()
+    results = await asyncio.gather(*(run(user) for user in user_list))
+    wall = time.time() - started
+
+    print("\nuser  P@10   ±std  iters  cands  seconds")
+    for r in results:
+        print(f"{r['user_id']:>4}  {r['score']:.2f}  {r['score_std']:.3f}  {r['iterations']:>5}  "
+              f"{r['candidates_evaluated']:>5}  {r['elapsed']:7.1f}")
+    mean_score = sum(r['score'] for r in results) / len(results) if results else 0.0
+    total_candidates = sum(r['candidates_evaluated'] for r in results)
+    failed = sum(1 for r in results if "error" in r)
+    print(f"\nUsers: {len(results)} (failed: {failed})  wall time: {wall:.1f}s  prompts evaluated: {total_candidates}")
+    print(f"Mean Precision@10: {mean_score:.4f}")
+    await OpenAiAgent.aclose()
+    return results
+
+
+async def warm_ground_truth():
+    # Makes sure the pool is cached; ground truth then uses the same keys the server reads.
+    await expand_story_pool(seed_stories, target_count=30)
+    gt_results, sample_results = await asyncio.gather(
+        asyncio.gather(*(ground_truth_top10(user['tags']) for user in users)),
+        asyncio.gather(*(simulated_tag_samples(user['tags']) for user in users))
+    )
+    for user, gt_ids, samples in zip(users, gt_results, sample_results):
+        print(f"[{user['id']}] ground truth: {gt_ids}  tag samples: {len(samples)}")
+    await OpenAiAgent.aclose()
+
+
+async def update_pool(changes_file: str):
+    with open(changes_file, encoding="utf-8") as f:
+        changes = json.load(f)
+    upserts, retire = changes.get("upsert", []), changes.get("retire", [])
+    version, embedded = await update_stories(upserts, retire)
+    print(f"Pool version {version}: {len(upserts)} upserted ({embedded} re-embedded), {len(retire)} retired.")
+    await OpenAiAgent.aclose()
+
+
+async def export_embeddings(path: str):
+    count = await export_redis_embeddings(path)
+    print(f"Exported {count} story embeddings to {path}.")
+
+
+async def import_embeddings(path: str):
+    count = await import_redis_embeddings(path)
+    print(f"Imported {count} story embeddings from {path} into Redis.")
+
+
+async def migrate_embeddings():
+    migrated = await migrate_story_embeddings()
+    print(f"Migrated {migrated} story embeddings to the binary float32 format.")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sekai story recommendation prompt optimizer")
+    parser.add_argument("--watch-pool", action="store_true",
+                        help="subscribe to story pool updates instead of checking the version on every call")
+    parser.add_argument("--metrics-out",
+                        help="write stage timings, token/Redis counters and cache hit rates here on exit "
+                             "(Prometheus text if the path ends in .prom, otherwise a JSON line)")
+    parser.add_argument("--no-telemetry", action="store_true", help="disable instrumentation")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("optimize", help="optimize the recommendation prompt (default)")
+    optimize_all = subparsers.add_parser("optimize-all", help="optimize prompts for every user concurrently")
+    optimize_all.add_argument("--users-file", help="JSON file with a list of {id, tags} users (default: src/data/user.py)")
+    optimize_all.add_argument("--max-seconds", type=float, default=15, help="time budget per user")
+    optimize_all.add_argument("--llm-concurrency", type=int, default=8, help="global cap on in-flight LLM calls")
+    optimize_all.add_argument("--max-users", type=int, default=32, help="users optimized at the same time")
+    optimize_all.add_argument("--candidates", type=int, default=4, help="candidate prompts proposed per round")
+    optimize_all.add_argument("--beam-width", type=int, default=2, help="best prompts kept between rounds")
+    optimize_all.add_argument("--tag-samples", type=int, default=3,
+                              help="simulated tag sets every candidate is scored on")
+    subparsers.add_parser("warm-gt", help="precompute and cache ground truth for every user")
+    update = subparsers.add_parser("update-pool", help="add, update or retire stories without a rebuild")
+    update.add_argument("changes_file", help='JSON file: {"upsert": [stories...], "retire": [ids...]}')
+    export = subparsers.add_parser("export-embeddings", help="snapshot Redis story embeddings to a memory-mappable store")
+    export.add_argument("path", nargs="?", default=EMBEDDING_STORE_PATH)
+    import_ = subparsers.add_parser("import-embeddings", help="load a memory-mappable store back into Redis")
+    import_.add_argument("path", nargs="?", default=EMBEDDING_STORE_PATH)
+    subparsers.add_parser("migrate-embeddings", help="rewrite legacy JSON story embeddings as binary float32")
+    return parser.parse_args()
+
+
+def write_metrics(path: str):
+    if path.endswith(".prom"):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(telemetry.export_prometheus())
+    else:
+        telemetry.export_jsonl(path)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    telemetry.configure(enabled=not args.no_telemetry)
+    if args.command == "optimize-all":
+        asyncio.run(optimize_all_users(
+            load_users(args.users_file),
+            max_seconds=args.max_seconds,
+            max_llm_concurrency=args.llm_concurrency,
+            max_users_in_flight=args.max_users,
+            candidates=args.candidates,
+            beam_width=args.beam_width,
+            tag_samples=args.tag_samples
+        ))
+    elif args.command == "warm-gt":
+        asyncio.run(warm_ground_truth())
+    elif args.command == "update-pool":
+        asyncio.run(update_pool(args.changes_file))
+    elif args.command == "export-embeddings":
+        asyncio.run(export_embeddings(args.path))
+    elif args.command == "import-embeddings":
+        asyncio.run(import_embeddings(args.path))
+    elif args.command == "migrate-embeddings":
+        asyncio.run(migrate_embeddings())
+    else:
+        asyncio.run(main(watch_pool=args.watch_pool))
+    pool_matrix_cache.close()
+    shutdown_executor()
+    if args.metrics_out:
+        write_metrics(args.metrics_out)
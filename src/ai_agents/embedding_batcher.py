@@ -0,0 +1,62 @@
+import asyncio
+from typing import List, Optional, Set, Tuple
+
+from src.ai_agents.open_ai import open_ai_agent
+
+
+class EmbeddingBatcher:
+    """Coalesces embedding requests arriving within ``window_ms`` into one embeddings call."""
+
+    def __init__(self, model: str, window_ms: float = 5.0, max_batch: int = 256):
+        self.model = model
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # The loop only keeps weak references to tasks; in-flight sends are held here.
+        self._sending: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> List[float]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush_now()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        self._flush_now()
+
+    def _flush_now(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        # Identical texts in one window are embedded once.
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            resp = await open_ai_agent.create_embeddings(model=self.model, input=texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        by_text = {texts[d.index]: d.embedding for d in resp.data}
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+    async def aclose(self):
+        # Sends everything pending and waits for it, so the client can be closed afterwards.
+        self._flush_now()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
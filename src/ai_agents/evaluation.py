@@ -1,15 +1,47 @@
-from typing import Tuple, List, Dict
-from src.ai_agents.recommend import recommend_stories
+from typing import Tuple, List, Dict, Optional
+from src.ai_agents.recommend import STREAM_STORY_IDS, recommend_stories, prefilter_stories_with_embeddings
+from src.ai_agents.id_stream import stream_story_ids
+from src.ai_agents.story_blocks import STORIES_HEADER, build_stories_text
+from src.data.user import users
 from src.dataclass import Story
 import re
 import os
+import asyncio
 import json
-from src.ai_agents.open_ai import OpenAiAgent
-from src.cache.redis import get_story_embeddings_batch
+import hashlib
+from src.ai_agents.open_ai import open_ai_agent
+from src.cache.redis import (
+    cache_ground_truth,
+    cache_tag_samples,
+    get_ground_truth,
+    get_story_pool_version,
+    get_tag_samples,
+    story_pool_version,
+)
+from src.telemetry import telemetry
 
-open_ai_agent = OpenAiAgent()
+GT_MODEL = "gpt-4o-mini"
+# Bump whenever the ground-truth prompt or prefilter changes so cached answers are not reused.
+GT_PROMPT_VERSION = 2
+TAG_SAMPLE_MODEL = "gpt-4o-mini"
+# Bump whenever the tag-simulation prompt changes so cached samples are regenerated.
+TAG_SAMPLE_VERSION = 1
+TAG_SAMPLE_TEMPERATURE = 0.7
+TAG_SAMPLES = int(os.getenv("TAG_SAMPLES", 3))
+# Ground truth and tag samples for profiles other than the known users (e.g. any profile sent
+# to /evaluate) expire after this many seconds, so arbitrary callers cannot grow Redis forever.
+GT_CACHE_TTL = int(os.getenv("GT_CACHE_TTL", 7 * 24 * 3600))
+_KNOWN_PROFILES = {json.dumps(user["tags"], ensure_ascii=False) for user in users}
 
-def simulate_user_tags(user_profile: List[str]) -> List[str]:
+def cache_ttl(user_profile: List[str]) -> Optional[int]:
+    return None if json.dumps(user_profile, ensure_ascii=False) in _KNOWN_PROFILES else GT_CACHE_TTL
+
+@telemetry.timed("simulate_tags")
+async def simulate_user_tags(
+    user_profile: List[str],
+    seed: Optional[int] = None,
+    temperature: float = 0.2
+) -> List[str]:
     system_prompt = (
         "You are a tag prediction assistant. Given a list of available preference tags for a user, "
         "select between 5 and 10 tags that best represent what this user would choose on Sekai’s first screen. "
@@ -18,54 +50,76 @@ def simulate_user_tags(user_profile: List[str]) -> List[str]:
     )
     user_prompt = f"Available Tags:\n{json.dumps(user_profile, ensure_ascii=False)}"
 
-    resp = open_ai_agent.client.chat.completions.create(
-        model="gpt-4o-mini",
+    request = dict(
+        model=TAG_SAMPLE_MODEL,
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ],
-        temperature=0.2,
+        temperature=temperature,
         max_tokens=200
     )
+    if seed is not None:
+        request["seed"] = seed
+    resp = await open_ai_agent.chat_completion(**request)
     generated = resp.choices[0].message.content
     match = re.search(r"\[.*\]", generated, re.S)
     simulated_tags = json.loads(match.group(0))
     return simulated_tags
 
-async def generate_embedding(text: str) -> List[float]:
-    resp = open_ai_agent.client.embeddings.create(
-        model="text-embedding-ada-002",
-        input=text
-    )
-    return resp.data[0].embedding
-
-def calculate_similarity(embedding1: List[float], embedding2: List[float]) -> float:
-    dot_product = sum(a * b for a, b in zip(embedding1, embedding2))
-    norm1 = sum(a * a for a in embedding1) ** 0.5
-    norm2 = sum(b * b for b in embedding2) ** 0.5
-    return dot_product / (norm1 * norm2)
-
-async def prefilter_stories_with_embeddings(
-    user_tags: List[str],
-    story_pool: List[Story],
-    top_k: int = 60
-) -> List[Story]:
-    user_embedding = await generate_embedding(" ".join(user_tags))
-    
-    story_ids = [s['id'] for s in story_pool]
-    story_embeddings = await get_story_embeddings_batch(story_ids)
-    
-    similarities = []
-    for story, story_embedding in zip(story_pool, story_embeddings):
-        if story_embedding:
-            similarity = calculate_similarity(user_embedding, story_embedding)
-            similarities.append((story, similarity))
-    
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return [s[0] for s in similarities[:top_k]]
-
-async def ground_truth_top10(user_profile: dict, story_pool: List[Story]) -> List[int]:
-    filtered_stories = await prefilter_stories_with_embeddings(user_profile, story_pool)
+def tag_samples_key(user_profile: List[str]) -> str:
+    payload = json.dumps({
+        "profile": user_profile,
+        "model": TAG_SAMPLE_MODEL,
+        "temperature": TAG_SAMPLE_TEMPERATURE,
+        "version": TAG_SAMPLE_VERSION,
+    }, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+async def simulated_tag_samples(user_profile: List[str], k: int = TAG_SAMPLES) -> List[List[str]]:
+    # Sample i is drawn with seed i and kept in Redis, so every evaluation of a profile sees the
+    # same k tag sets. Asking for more samples later only generates the missing ones.
+    key = tag_samples_key(user_profile)
+    samples = await get_tag_samples(key) or []
+    telemetry.record_cache("tag_samples", len(samples) >= k)
+    if len(samples) < k:
+        samples += await asyncio.gather(*(
+            simulate_user_tags(user_profile, seed=i, temperature=TAG_SAMPLE_TEMPERATURE)
+            for i in range(len(samples), k)
+        ))
+        await cache_tag_samples(key, samples, cache_ttl(user_profile))
+    return samples[:k]
+
+def ground_truth_key(user_profile: List[str], pool_version: Optional[str]) -> str:
+    payload = json.dumps({
+        "profile": user_profile,
+        "pool_version": pool_version,
+        "model": GT_MODEL,
+        "prompt_version": GT_PROMPT_VERSION,
+    }, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+@telemetry.timed("ground_truth")
+async def ground_truth_top10(user_profile: List[str], story_pool: Optional[List[Story]] = None) -> List[int]:
+    # Temperature 0 on a fixed profile and pool: the answer only changes with its inputs, so store it.
+    # Leave story_pool as None for the cached pool: its version is one GET, where an ad-hoc pool
+    # has to be hashed in full.
+    if story_pool is None:
+        pool_version = await get_story_pool_version()
+    else:
+        pool_version = story_pool_version(json.dumps(story_pool))
+    key = ground_truth_key(user_profile, pool_version)
+    cached = await get_ground_truth(key)
+    telemetry.record_cache("ground_truth", cached is not None)
+    if cached is not None:
+        return cached
+    gt_ids = await compute_ground_truth_top10(user_profile, story_pool)
+    await cache_ground_truth(key, gt_ids, cache_ttl(user_profile))
+    return gt_ids
+
+async def compute_ground_truth_top10(user_profile: List[str], story_pool: Optional[List[Story]] = None) -> List[int]:
+    # Always dense: the reference answer must not move with RETRIEVAL_MODE.
+    filtered_stories = await prefilter_stories_with_embeddings(user_profile, story_pool, mode="dense")
     system_prompt = (
         "You are an expert story recommender. Given a user’s full profile and a list of Sekai stories "
         "(each has ID, title, tags, and intro)"
@@ -76,17 +130,15 @@ async def ground_truth_top10(user_profile: dict, story_pool: List[Story]) -> Lis
         "Under no circumstances should you return fewer or more than 10 IDs. "
     )
 
-    stories_text = ""
-    for s in filtered_stories:
-        stories_text += str(s) + "\n"
+    stories_text, candidates = build_stories_text(filtered_stories)
 
     user_prompt = (
         f"User Profile:\n{json.dumps(user_profile, ensure_ascii=False)}\n\n"
-        f"Stories:\n{stories_text}"
+        f"{STORIES_HEADER}\n{stories_text}"
     )
 
-    resp = open_ai_agent.client.chat.completions.create(
-        model="gpt-4o-mini",
+    request = dict(
+        model=GT_MODEL,
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
@@ -94,23 +146,34 @@ async def ground_truth_top10(user_profile: dict, story_pool: List[Story]) -> Lis
         temperature=0.0,
         max_tokens=200
     )
+    if STREAM_STORY_IDS:
+        return await stream_story_ids(open_ai_agent, [s['id'] for s in candidates], **request)
+
+    resp = await open_ai_agent.chat_completion(**request)
     generated = resp.choices[0].message.content
     match = re.search(r"\[.*\]", generated, re.S)
     content = json.loads(match.group(0))
     return content
 
+@telemetry.timed("evaluate")
 async def evaluate_for_user(
     user_profile: List[str],
     prompt: str,
-    story_pool: List[Story]
+    story_pool: Optional[List[Story]] = None,
+    sample_index: int = 0
 ) -> Tuple[float, Dict]:
-    user_tags = simulate_user_tags(user_profile)
-    print(f"*****user_tags: {user_tags}")
-
-    rec_ids = await recommend_stories(prompt, user_tags, story_pool)
-    print(f"*****recomend id: {rec_ids}")
+    async def recommendation_branch() -> Tuple[List[str], List[int]]:
+        user_tags = (await simulated_tag_samples(user_profile, sample_index + 1))[sample_index]
+        print(f"*****user_tags: {user_tags}")
+        rec_ids = await recommend_stories(prompt, user_tags, story_pool)
+        print(f"*****recomend id: {rec_ids}")
+        return user_tags, rec_ids
 
-    gt_ids = await ground_truth_top10(user_profile, story_pool)
+    # The two branches only share their inputs, so their LLM calls can overlap.
+    (user_tags, rec_ids), gt_ids = await asyncio.gather(
+        recommendation_branch(),
+        ground_truth_top10(user_profile, story_pool)
+    )
     print(f"*****truth id: {gt_ids}")
     true_positives = len(set(rec_ids) & set(gt_ids))
     precision = true_positives / 10.0
@@ -122,3 +185,22 @@ async def evaluate_for_user(
     }
 
     return precision, failure_detail
+
+@telemetry.timed("score_prompt")
+async def score_prompt(
+    prompt: str,
+    tag_samples: List[List[str]],
+    gt_ids: List[int],
+    story_pool: Optional[List[Story]] = None
+) -> Tuple[float, float, List[Dict]]:
+    # Scores one prompt on a fixed set of simulated tag samples against a known ground truth,
+    # so every candidate sees the same inputs and the scores are comparable.
+    rec_lists = await asyncio.gather(*(recommend_stories(prompt, tags, story_pool) for tags in tag_samples))
+    precisions = [len(set(rec_ids) & set(gt_ids)) / 10.0 for rec_ids in rec_lists]
+    mean = sum(precisions) / len(precisions)
+    std = (sum((p - mean) ** 2 for p in precisions) / len(precisions)) ** 0.5
+    details = [
+        {"simulated_tags": tags, "rec_ids": rec_ids, "gt_ids": gt_ids, "precision": precision}
+        for tags, rec_ids, precision in zip(tag_samples, rec_lists, precisions)
+    ]
+    return mean, std, details
@@ -0,0 +1,80 @@
+from typing import Any, Iterable, List, Optional, Set
+
+from src.ai_agents.open_ai import ChatStream, OpenAiAgent
+from src.telemetry import telemetry
+
+
+class StoryIdStreamParser:
+    """Incrementally pulls story IDs out of a streamed JSON array.
+
+    Digits are buffered across chunk boundaries and only counted inside ``[...]``.
+    IDs not in ``valid_ids`` (when given) and repeats are dropped; ``done`` flips once
+    ``limit`` unique valid IDs have been seen.
+    """
+
+    def __init__(self, valid_ids: Optional[Iterable[int]] = None, limit: int = 10):
+        self.valid_ids: Optional[Set[int]] = set(int(i) for i in valid_ids) if valid_ids is not None else None
+        self.limit = limit
+        self.ids: List[int] = []
+        self._seen: Set[int] = set()
+        self._digits = ""
+        self._in_array = False
+
+    @property
+    def done(self) -> bool:
+        return len(self.ids) >= self.limit
+
+    def feed(self, text: str) -> List[int]:
+        accepted = []
+        for ch in text:
+            if self.done:
+                break
+            if ch == "[":
+                self._in_array = True
+                self._digits = ""
+            elif self._in_array and ch.isdigit():
+                self._digits += ch
+            else:
+                self._flush(accepted)
+                if ch == "]":
+                    self._in_array = False
+        return accepted
+
+    def finish(self) -> List[int]:
+        accepted: List[int] = []
+        self._flush(accepted)
+        return accepted
+
+    def _flush(self, accepted: List[int]):
+        if not self._digits:
+            return
+        story_id = int(self._digits)
+        self._digits = ""
+        if story_id in self._seen or (self.valid_ids is not None and story_id not in self.valid_ids):
+            return
+        if not self.done:
+            self._seen.add(story_id)
+            self.ids.append(story_id)
+            accepted.append(story_id)
+
+
+async def stream_story_ids(
+    agent: OpenAiAgent,
+    valid_ids: Optional[Iterable[int]],
+    limit: int = 10,
+    **kwargs: Any
+) -> List[int]:
+    # Returns as soon as ``limit`` valid IDs arrive; closing the stream drops the
+    # connection so the rest of the completion is not generated.
+    async def consume(deltas: ChatStream) -> List[int]:
+        # A retried attempt starts over with a fresh parser.
+        parser = StoryIdStreamParser(valid_ids, limit)
+        async for delta in deltas:
+            parser.feed(delta)
+            if parser.done:
+                telemetry.incr("llm_streams_cut_short_total")
+                break
+        parser.finish()
+        return parser.ids
+
+    return await agent.stream_chat(consume, **kwargs)
@@ -1,9 +1,270 @@
+import asyncio
 import dotenv
 import os
-from openai import OpenAI
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from src.ai_agents.rate_limit import (
+    AdaptiveConcurrencyLimiter,
+    TokenBucket,
+    backoff_delay,
+    estimate_request_tokens,
+    latency_kind,
+)
+from src.deadline import within_deadline
+from src.telemetry import telemetry
 
 dotenv.load_dotenv()
 
+T = TypeVar("T")
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 20))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", 60))
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", 0))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+# Per-model account budgets; 0 leaves that dimension unlimited.
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", 0))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", 0))
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+class ChatStream:
+    """Text deltas of one streamed chat completion, counting what has been received."""
+
+    def __init__(self, stream: Any):
+        self._chunks = stream.__aiter__()
+        self.chars = 0
+        self.usage: Any = None
+
+    def __aiter__(self) -> "ChatStream":
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            chunk = await self._chunks.__anext__()
+            # Sent once, with no choices, when the stream runs to the end (include_usage).
+            if getattr(chunk, "usage", None) is not None:
+                self.usage = chunk.usage
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                self.chars += len(delta)
+                return delta
+
+
 class OpenAiAgent:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
\ No newline at end of file
+    """Every agent shares one AsyncOpenAI client and one set of limits.
+
+    Requests pass per-model requests/tokens-per-minute buckets (token cost is estimated
+    from the prompt and settled against the reported usage), then an adaptive cap on
+    in-flight calls. 429s, 5xx and connection errors are retried with jittered backoff.
+    """
+
+    _async_client: Optional[AsyncOpenAI] = None
+    # Ceiling for the adaptive in-flight cap; 0 falls back to the connection pool size.
+    _max_in_flight: int = OPENAI_MAX_IN_FLIGHT
+    _in_flight: Optional[AdaptiveConcurrencyLimiter] = None
+    _rate_limits: Dict[str, Tuple[float, float]] = {}
+    _buckets: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+
+    @classmethod
+    def set_max_concurrency(cls, limit: int):
+        cls._max_in_flight = limit
+        cls._in_flight = None
+
+    @classmethod
+    def set_rate_limits(cls, model: str, rpm: float, tpm: float):
+        cls._rate_limits[model] = (rpm, tpm)
+        cls._buckets.pop(model, None)
+
+    @classmethod
+    def _limiter(cls) -> AdaptiveConcurrencyLimiter:
+        # Created lazily so waiters belong to the running event loop.
+        if cls._in_flight is None:
+            cls._in_flight = AdaptiveConcurrencyLimiter(cls._max_in_flight or OPENAI_MAX_CONNECTIONS)
+        return cls._in_flight
+
+    @classmethod
+    def _model_buckets(cls, model: str) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        buckets = cls._buckets.get(model)
+        if buckets is None:
+            rpm, tpm = cls._rate_limits.get(model, (OPENAI_RPM, OPENAI_TPM))
+            buckets = cls._buckets[model] = (TokenBucket(rpm) if rpm > 0 else None,
+                                             TokenBucket(tpm) if tpm > 0 else None)
+        return buckets
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        if OpenAiAgent._async_client is None:
+            OpenAiAgent._async_client = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                # Retries happen in _call, where they also feed the limiter.
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+                    ),
+                    timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=5.0)
+                )
+            )
+        return OpenAiAgent._async_client
+
+    async def chat_completion(self, **kwargs: Any):
+        with telemetry.span("llm.chat", model=kwargs.get("model")):
+            resp = await self._call(self.async_client.chat.completions.create, kwargs)
+        telemetry.record_usage("chat", kwargs.get("model"), getattr(resp, "usage", None))
+        return resp
+
+    async def create_embeddings(self, **kwargs: Any):
+        with telemetry.span("llm.embeddings", model=kwargs.get("model")):
+            resp = await self._call(self.async_client.embeddings.create, kwargs)
+        telemetry.record_usage("embeddings", kwargs.get("model"), getattr(resp, "usage", None))
+        return resp
+
+    @asynccontextmanager
+    async def chat_stream(self, **kwargs: Any) -> AsyncIterator[ChatStream]:
+        """Opens a streamed chat completion and yields its text deltas.
+
+        The call keeps its in-flight slot until the stream is closed on exit, and its token
+        reservation is settled then, from reported usage or else from the characters
+        received. Opening is retried like any call; use ``stream_chat`` to also retry
+        errors raised while reading.
+        """
+        async with self._stream(kwargs, retry=True) as deltas:
+            yield deltas
+
+    async def stream_chat(self, consume: Callable[[ChatStream], Awaitable[T]], **kwargs: Any) -> T:
+        # ``consume`` reads one attempt's deltas; a retryable error, opening or mid-stream,
+        # reruns it from the start on a fresh stream. This is the only retry loop, so a
+        # stream gets as many attempts as any other call.
+        async def attempt() -> T:
+            async with self._stream(kwargs, retry=False) as deltas:
+                return await consume(deltas)
+
+        return await within_deadline(self._with_retries(attempt, kwargs.get("model")))
+
+    @asynccontextmanager
+    async def _stream(self, kwargs: Dict[str, Any], retry: bool) -> AsyncIterator[ChatStream]:
+        model = kwargs.get("model")
+        with telemetry.span("llm.chat_stream", model=model):
+            opening = self._with_retries(lambda: self._open_stream(kwargs), model) if retry else self._open_stream(kwargs)
+            stream, limiter, tokens, estimate = await within_deadline(opening)
+            deltas = ChatStream(stream)
+            started = time.monotonic()
+            latency: Optional[float] = None
+            overloaded = False
+            try:
+                yield deltas
+                latency = time.monotonic() - started
+            except openai.RateLimitError:
+                overloaded = True
+                raise
+            finally:
+                try:
+                    await stream.close()
+                finally:
+                    # Streams cut short run for varying lengths, so they get their own latency baseline.
+                    limiter.release(latency_kind(kwargs) + ("stream",), latency, overloaded)
+                    # Usage arrives in the last chunk; a stream closed before it is estimated.
+                    usage = deltas.usage or SimpleNamespace(
+                        prompt_tokens=estimate_request_tokens({**kwargs, "max_tokens": 0}),
+                        completion_tokens=deltas.chars // 4
+                    )
+                    used = getattr(usage, "total_tokens", None) or usage.prompt_tokens + usage.completion_tokens
+                    if tokens is not None:
+                        tokens.adjust(estimate - used)
+                    telemetry.record_usage("chat", model, usage, estimated=deltas.usage is None)
+
+    async def _call(self, create, kwargs: Dict[str, Any]):
+        # Bounded by the caller's deadline, if any, including backoff and time spent queued.
+        return await within_deadline(self._with_retries(lambda: self._call_limited(create, kwargs), kwargs.get("model")))
+
+    async def _with_retries(self, run: Callable[[], Awaitable[T]], model: Optional[str]) -> T:
+        attempt = 0
+        while True:
+            try:
+                return await run()
+            except Exception as e:
+                if attempt >= OPENAI_MAX_RETRIES or not _is_retryable(e):
+                    raise
+                telemetry.incr("llm_retries_total", model=model, error=type(e).__name__)
+                await asyncio.sleep(backoff_delay(attempt, retry_after=_retry_after(e)))
+                attempt += 1
+
+    async def _reserve(self, kwargs: Dict[str, Any]) -> Tuple[Optional[TokenBucket], int]:
+        requests, tokens = self._model_buckets(kwargs.get("model"))
+        estimate = estimate_request_tokens(kwargs)
+        if requests is not None:
+            await requests.acquire()
+        if tokens is not None:
+            await tokens.acquire(estimate)
+        return tokens, estimate
+
+    async def _open_stream(
+        self,
+        kwargs: Dict[str, Any]
+    ) -> Tuple[Any, AdaptiveConcurrencyLimiter, Optional[TokenBucket], int]:
+        # On success the limiter slot stays taken; chat_stream releases it when the stream closes.
+        tokens, estimate = await self._reserve(kwargs)
+        limiter = self._limiter()
+        await limiter.acquire()
+        try:
+            stream = await self.async_client.chat.completions.create(
+                **{"stream_options": {"include_usage": True}, **kwargs, "stream": True}
+            )
+        except BaseException as e:
+            limiter.release(overloaded=isinstance(e, openai.RateLimitError))
+            raise
+        return stream, limiter, tokens, estimate
+
+    async def _call_limited(self, create, kwargs: Dict[str, Any]):
+        tokens, estimate = await self._reserve(kwargs)
+        limiter = self._limiter()
+        await limiter.acquire()
+        started = time.monotonic()
+        latency: Optional[float] = None
+        overloaded = False
+        try:
+            resp = await create(**kwargs)
+            latency = time.monotonic() - started
+        except openai.RateLimitError:
+            overloaded = True
+            raise
+        finally:
+            limiter.release(latency_kind(kwargs), latency, overloaded)
+        usage = getattr(resp, "usage", None)
+        if tokens is not None and usage is not None:
+            tokens.adjust(estimate - (getattr(usage, "total_tokens", 0) or 0))
+        return resp
+
+    @classmethod
+    def use_client(cls, client: Any):
+        # Swap in any object with the AsyncOpenAI chat/embeddings surface, e.g. a benchmark fake.
+        cls._async_client = client
+
+    @classmethod
+    async def aclose(cls):
+        if cls._async_client is not None:
+            await cls._async_client.close()
+            cls._async_client = None
+
+
+# The one agent every module calls through.
+open_ai_agent = OpenAiAgent()
@@ -1,15 +1,9 @@
 import os
 from typing import List, Dict
-from src.ai_agents.open_ai import OpenAiAgent
+from src.ai_agents.open_ai import open_ai_agent
+from src.telemetry import telemetry
 
-open_ai_agent = OpenAiAgent()
-
-def optimize_prompt(
-    last_prompt: str,
-    last_score: float,
-    failure_samples: List[Dict]
-) -> str:
-    
+def _optimizer_messages(last_prompt: str, last_score: float, failure_samples: List[Dict]) -> List[Dict[str, str]]:
     system_prompt = (
         "You are a prompt optimization assistant whose job is to iteratively refine "
         "recommendation prompts so that a downstream recommendation agent can achieve "
@@ -33,17 +27,26 @@ def optimize_prompt(
         f"Failure Examples:\n{failure_samples}\n\n"
         "Please produce a new prompt that will improve Precision@10.\n"
     )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_content}
+    ]
 
-    response = open_ai_agent.client.chat.completions.create(
+@telemetry.timed("propose_prompts")
+async def propose_prompts(
+    last_prompt: str,
+    last_score: float,
+    failure_samples: List[Dict],
+    n: int = 4
+) -> List[str]:
+    # One request with n choices: the input tokens are billed once, and the higher
+    # temperature spreads the candidates out. Duplicates of each other or of the input are dropped.
+    response = await open_ai_agent.chat_completion(
         model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content}
-        ],
-        temperature=0.3,
-        max_tokens=200
+        messages=_optimizer_messages(last_prompt, last_score, failure_samples),
+        temperature=0.9,
+        max_tokens=200,
+        n=n
     )
-
-    new_prompt = response.choices[0].message.content.strip()
-    return new_prompt
-
+    candidates = [c.message.content.strip() for c in response.choices if c.message.content]
+    return [c for c in dict.fromkeys(candidates) if c and c != last_prompt]
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import random
+import time
+from typing import Any, Deque, Dict, Hashable, Optional, Tuple
+
+
+class TokenBucket:
+    """Refills continuously at ``per_minute`` and holds at most one minute's worth.
+
+    ``acquire`` waits until the requested amount is available, then takes it. ``adjust``
+    settles a reservation against the real cost once it is known; a negative balance
+    simply delays later callers.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        # A request larger than the whole bucket waits for a full bucket instead of forever.
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD cap on in-flight requests, between ``min_limit`` and ``max_limit``.
+
+    Each success adds 1/limit; a rate-limit response, or latency drifting above
+    ``tolerance`` times (and ``slack`` seconds over) the fastest seen for that kind of
+    request, cuts the limit multiplicatively, at most once per typical request duration.
+    ``release`` is synchronous so it is safe in ``finally`` blocks of cancelled tasks.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, tolerance: float = 3.0, slack: float = 0.25):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(self.max_limit)
+        self.tolerance = tolerance
+        self.slack = slack
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+        self._latency: Dict[Hashable, Tuple[float, float]] = {}
+        self._last_decrease = 0.0
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we were cancelled; hand the slot on.
+                self.release()
+            raise
+
+    def release(self, kind: Optional[Hashable] = None, latency: Optional[float] = None, overloaded: bool = False):
+        self.in_flight -= 1
+        if overloaded:
+            self._decrease(0.5)
+        elif latency is not None:
+            self._observe(kind, latency)
+        self._wake()
+
+    def _observe(self, kind: Optional[Hashable], latency: float):
+        fastest, mean = self._latency.get(kind, (latency, latency))
+        fastest, mean = min(fastest, latency), mean + 0.2 * (latency - mean)
+        self._latency[kind] = (fastest, mean)
+        if mean > self.tolerance * fastest and mean - fastest > self.slack:
+            self._decrease(0.75, window=mean)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    def _decrease(self, factor: float, window: float = 1.0):
+        now = time.monotonic()
+        if now - self._last_decrease < window:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * factor)
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0, retry_after: Optional[float] = None) -> float:
+    # Full jitter; a server-provided Retry-After is a floor.
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+
+def estimate_request_tokens(kwargs: Dict[str, Any]) -> int:
+    # ~4 characters per token for the prompt, plus the most the completion may use.
+    if "messages" in kwargs:
+        chars = sum(len(str(m.get("content") or "")) for m in kwargs["messages"])
+        completion = (kwargs.get("max_tokens") or 0) * (kwargs.get("n") or 1)
+    else:
+        inputs = kwargs.get("input") or ""
+        chars = len(inputs) if isinstance(inputs, str) else sum(len(str(i)) for i in inputs)
+        completion = 0
+    return chars // 4 + 1 + completion
+
+
+def latency_kind(kwargs: Dict[str, Any]) -> Tuple[Any, ...]:
+    # Requests whose latency is comparable: same model, output budget and choice count, and
+    # prompt size (or embedding batch length) within a factor of two.
+    if "messages" in kwargs:
+        size = estimate_request_tokens({**kwargs, "max_tokens": 0})
+    else:
+        inputs = kwargs.get("input") or ""
+        size = 1 if isinstance(inputs, str) else len(inputs)
+    return kwargs.get("model"), kwargs.get("max_tokens"), kwargs.get("n") or 1, int(size).bit_length()
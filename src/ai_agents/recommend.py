@@ -1,54 +1,159 @@
 import os
 import re
+import asyncio
 import json
-from typing import List, Optional
+from typing import Awaitable, Callable, List, Optional
 from src.dataclass import Story
 from dotenv import load_dotenv
-from src.ai_agents.open_ai import OpenAiAgent
-from src.cache.redis import get_story_embeddings_batch
-
-open_ai_agent = OpenAiAgent()
+from src.ai_agents.open_ai import open_ai_agent
+from src.ai_agents.id_stream import stream_story_ids
+from src.ai_agents.story_blocks import STORIES_HEADER, build_stories_text
+from src.cache.redis import get_stories, get_story_embedding_matrix
+from src.cache.pool_matrix import pool_matrix_cache
+from src.cache.query_embedding_cache import query_embedding_cache
+from src.retrieval.scoring import EmbeddingMatrix, rank_stories
+from src.retrieval.tag_index import RETRIEVAL_MODE, RETRIEVAL_MODES, TagIndex, reciprocal_rank_fusion
+from src.telemetry import telemetry
 
 load_dotenv()
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Parse IDs from the token stream and stop generation once 10 valid ones have arrived.
+STREAM_STORY_IDS = os.getenv("STREAM_STORY_IDS", "1") not in ("0", "false", "False")
+
 async def generate_embedding(text: str) -> List[float]:
-    resp = open_ai_agent.client.embeddings.create(
-        model="text-embedding-ada-002",
+    resp = await open_ai_agent.create_embeddings(
+        model=EMBEDDING_MODEL,
         input=text
     )
     return resp.data[0].embedding
 
-def calculate_similarity(embedding1: List[float], embedding2: List[float]) -> float:
-    dot_product = sum(a * b for a, b in zip(embedding1, embedding2))
-    norm1 = sum(a * a for a in embedding1) ** 0.5
-    norm2 = sum(b * b for b in embedding2) ** 0.5
-    return dot_product / (norm1 * norm2)
+async def generate_embeddings(
+    texts: List[str],
+    batch_size: int = 100,
+    max_concurrency: int = 4
+) -> List[List[float]]:
+    # Many inputs per embeddings request, with at most max_concurrency requests in flight.
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            resp = await open_ai_agent.create_embeddings(
+                model=EMBEDDING_MODEL,
+                input=batch
+            )
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [embedding for batch in results for embedding in batch]
+
+# Cache misses for query embeddings go through this; the API server swaps in a micro-batcher.
+query_embedder: Callable[[str], Awaitable[List[float]]] = generate_embedding
+
+def set_query_embedder(embedder: Optional[Callable[[str], Awaitable[List[float]]]]):
+    global query_embedder
+    query_embedder = embedder or generate_embedding
+
+async def embed_query(user_tags: List[str]) -> List[float]:
+    return await query_embedding_cache.get(user_tags, EMBEDDING_MODEL, query_embedder)
+
+async def load_embedding_matrix(story_pool: List[Story]) -> EmbeddingMatrix:
+    matrix = await pool_matrix_cache.get()
+    if all(int(s['id']) in matrix.row_of for s in story_pool):
+        return matrix
+    # The caller's pool is not the cached one (or is missing embeddings); read it directly.
+    story_ids, vectors = await get_story_embedding_matrix([s['id'] for s in story_pool])
+    return EmbeddingMatrix(story_ids, vectors, copy=False)
+
+async def load_tag_index(story_pool: Optional[List[Story]]) -> TagIndex:
+    tag_index = await pool_matrix_cache.get_tag_index()
+    if story_pool is None or (
+        len(tag_index) == len(story_pool) and all(int(s['id']) in tag_index.row_of for s in story_pool)
+    ):
+        return tag_index
+    return TagIndex.from_stories(story_pool)
+
+def index_kind(index) -> str:
+    return "exact" if index is None else type(index).__name__
 
+def sharded_scorer(matrix: EmbeddingMatrix):
+    sharded = pool_matrix_cache.sharded
+    return sharded if sharded is not None and sharded.matrix is matrix else None
+
+async def dense_story_ids(user_tags: List[str], story_pool: Optional[List[Story]], top_k: int) -> List[int]:
+    with telemetry.span("prefilter.embed_query"):
+        user_embedding = await embed_query(user_tags)
+    if story_pool is None:
+        return await prefilter_story_ids(user_embedding, top_k)
+    with telemetry.span("prefilter.load_matrix"):
+        matrix = await load_embedding_matrix(story_pool)
+    index = pool_matrix_cache.search_index if matrix is pool_matrix_cache.matrix else None
+    sharded = sharded_scorer(matrix) if index is None else None
+    if sharded is not None and len({int(s['id']) for s in story_pool}) == len(matrix):
+        # The pool is the whole cached matrix, so the worker pool can rank it off the event loop.
+        with telemetry.span("prefilter.score", index="ShardedScorer"):
+            return [story_id for story_id, _ in await sharded.search(user_embedding, top_k)]
+    with telemetry.span("prefilter.score", index=index_kind(index)):
+        return [int(s['id']) for s in rank_stories(matrix, user_embedding, story_pool, top_k, index=index)]
+
+async def tag_story_ids(user_tags: List[str], story_pool: Optional[List[Story]], top_k: int) -> List[int]:
+    tag_index = await load_tag_index(story_pool)
+    with telemetry.span("prefilter.tag_score"):
+        return [story_id for story_id, _ in tag_index.search(user_tags, top_k)]
+
+@telemetry.timed("prefilter")
 async def prefilter_stories_with_embeddings(
     user_tags: List[str],
-    story_pool: List[Story],
-    top_k: int = 60
+    story_pool: Optional[List[Story]] = None,
+    top_k: int = 60,
+    mode: Optional[str] = None
 ) -> List[Story]:
-    user_embedding = await generate_embedding(" ".join(user_tags))
-    
-    story_ids = [s['id'] for s in story_pool]
-    story_embeddings = await get_story_embeddings_batch(story_ids)
-    
-    similarities = []
-    for story, story_embedding in zip(story_pool, story_embeddings):
-        if story_embedding:
-            similarity = calculate_similarity(user_embedding, story_embedding)
-            similarities.append((story, similarity))
-    
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return [s[0] for s in similarities[:top_k]]
+    # mode: "dense" embeddings, "tags" inverted index (no embedding call), or "hybrid" RRF of both.
+    # Without an explicit pool, rank the cached pool and hydrate only the top_k stories.
+    mode = mode or RETRIEVAL_MODE
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"unknown retrieval mode {mode!r}; expected one of {RETRIEVAL_MODES}")
+    if mode == "dense":
+        story_ids = await dense_story_ids(user_tags, story_pool, top_k)
+    elif mode == "tags":
+        story_ids = await tag_story_ids(user_tags, story_pool, top_k)
+    else:
+        # Look deeper in each list so stories ranked moderately by both can surface.
+        rankings = await asyncio.gather(
+            dense_story_ids(user_tags, story_pool, 2 * top_k),
+            tag_story_ids(user_tags, story_pool, 2 * top_k)
+        )
+        story_ids = [story_id for story_id, _ in reciprocal_rank_fusion(rankings, top_k)]
+    if story_pool is None:
+        with telemetry.span("prefilter.hydrate"):
+            return [s for s in await get_stories(story_ids) if s is not None]
+    by_id = {int(s['id']): s for s in story_pool}
+    return [by_id[story_id] for story_id in story_ids]
+
+async def prefilter_story_ids(user_embedding: List[float], top_k: int = 60) -> List[int]:
+    with telemetry.span("prefilter.load_matrix"):
+        matrix = await pool_matrix_cache.get()
+    index = pool_matrix_cache.search_index
+    sharded = sharded_scorer(matrix) if index is None else None
+    with telemetry.span("prefilter.score", index=index_kind(index or sharded)):
+        if sharded is not None:
+            ranked = await sharded.search(user_embedding, top_k)
+        elif index is not None:
+            ranked = index.search(user_embedding, top_k)
+        else:
+            ranked = matrix.top_k(user_embedding, top_k)
+    return [story_id for story_id, _ in ranked]
 
+@telemetry.timed("recommend")
 async def recommend_stories(
     prompt: str,
     user_tags: List[str],
-    story_pool: List[Story]
+    story_pool: Optional[List[Story]] = None,
+    stream: Optional[bool] = None,
+    retrieval: Optional[str] = None
 ) -> List[int]:
-    filtered_stories = await prefilter_stories_with_embeddings(user_tags, story_pool)
+    filtered_stories = await prefilter_stories_with_embeddings(user_tags, story_pool, mode=retrieval)
     
     system_prompt = (
         "You are a lightning-fast recommendation engine. "
@@ -59,22 +164,15 @@ async def recommend_stories(
 
     tags_str = json.dumps(user_tags, ensure_ascii=False)
 
-    stories_text = ""
-    for s in filtered_stories:
-        stories_text += (
-            f"ID: {int(s['id'])}\n"
-            f"Title: {s['title']}\n"
-            f"Intro: {s['intro']}\n"
-            f"Tags: {', '.join(s['tags'])}\n\n"
-        )
+    stories_text, candidates = build_stories_text(filtered_stories)
 
     user_prompt = (
         f"Prompt Instructions:\n{prompt}\n\n"
         f"User Tags: {tags_str}\n\n"
-        f"Stories:\n{stories_text}"
+        f"{STORIES_HEADER}\n{stories_text}"
     )
 
-    resp = open_ai_agent.client.chat.completions.create(
+    request = dict(
         model="gpt-4o-mini",
         messages=[
             {"role": "system", "content": system_prompt},
@@ -83,6 +181,11 @@ async def recommend_stories(
         temperature=0.0,
         max_tokens=500
     )
+    use_stream = STREAM_STORY_IDS if stream is None else stream
+    if use_stream:
+        return await stream_story_ids(open_ai_agent, [s['id'] for s in candidates], **request)
+
+    resp = await open_ai_agent.chat_completion(**request)
 
     generated = resp.choices[0].message.content
     match = re.search(r"\[.*\]", generated, re.S)
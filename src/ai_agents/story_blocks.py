@@ -0,0 +1,70 @@
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.dataclass import Story
+
+STORY_TOKEN_BUDGET = int(os.getenv("STORY_TOKEN_BUDGET", 4000))
+STORIES_HEADER = "Stories (one per line: id|title|tags|intro):"
+
+# Intro lengths (in words) tried, longest first, before any candidate is dropped.
+_INTRO_WORD_STEPS = (None, 20, 12, 6, 0)
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English with the OpenAI tokenizers; good enough for a budget.
+    return len(text) // 4 + 1
+
+
+def _clean(text: str) -> str:
+    return " ".join(str(text).replace("|", "/").split())
+
+
+class StoryBlockCache:
+    """Compact one-line prompt blocks per story, serialized once and reused across prompts.
+
+    Entries are keyed by story id and checked against the story's fields, so an edited
+    story is re-serialized while unchanged ones are never rebuilt.
+    """
+
+    def __init__(self):
+        self._parts: Dict[int, Tuple[Tuple[str, str, Tuple[str, ...]], str, List[str]]] = {}
+
+    def _get_parts(self, story: Story) -> Tuple[str, List[str]]:
+        fingerprint = (story['title'], story['intro'], tuple(story['tags']))
+        cached = self._parts.get(int(story['id']))
+        if cached is None or cached[0] != fingerprint:
+            head = f"{int(story['id'])}|{_clean(story['title'])}|{','.join(_clean(t) for t in story['tags'])}|"
+            cached = (fingerprint, head, _clean(story['intro']).split())
+            self._parts[int(story['id'])] = cached
+        return cached[1], cached[2]
+
+    def block(self, story: Story, intro_words: Optional[int] = None) -> str:
+        head, intro = self._get_parts(story)
+        if intro_words is None or intro_words >= len(intro):
+            return head + " ".join(intro)
+        return head + " ".join(intro[:intro_words]) + ("…" if intro_words else "")
+
+    def build(self, stories: Sequence[Story], max_tokens: int = STORY_TOKEN_BUDGET) -> Tuple[str, List[Story]]:
+        # Shorten every intro step by step first; only then drop the lowest-ranked candidates.
+        stories = list(stories)
+        blocks: List[str] = []
+        for intro_words in _INTRO_WORD_STEPS:
+            blocks = [self.block(s, intro_words) for s in stories]
+            if sum(estimate_tokens(b) for b in blocks) <= max_tokens:
+                return "\n".join(blocks), stories
+        total = sum(estimate_tokens(b) for b in blocks)
+        while stories and total > max_tokens:
+            total -= estimate_tokens(blocks.pop())
+            stories.pop()
+        return "\n".join(blocks), stories
+
+    def forget(self, story_ids: Sequence[int]):
+        for story_id in story_ids:
+            self._parts.pop(int(story_id), None)
+
+
+story_block_cache = StoryBlockCache()
+
+
+def build_stories_text(stories: Sequence[Story], max_tokens: int = STORY_TOKEN_BUDGET) -> Tuple[str, List[Story]]:
+    return story_block_cache.build(stories, max_tokens)
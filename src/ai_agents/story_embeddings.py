@@ -0,0 +1,43 @@
+import hashlib
+from typing import List
+
+from src.dataclass import Story
+from src.ai_agents.recommend import EMBEDDING_MODEL, generate_embeddings
+from src.cache.redis import cache_story_embeddings_batch, get_story_text_hashes
+from src.telemetry import telemetry
+
+
+def story_text(story: Story) -> str:
+    return f"{story['title']} {story['intro']} {' '.join(story['tags'])}"
+
+
+def story_text_hash(story: Story) -> str:
+    return hashlib.sha1(f"{EMBEDDING_MODEL}\n{story_text(story)}".encode("utf-8")).hexdigest()
+
+
+@telemetry.timed("embed_stories")
+async def embed_and_cache_stories(
+    stories: List[Story],
+    batch_size: int = 100,
+    max_concurrency: int = 4
+) -> int:
+    # Skip stories whose text is already embedded under the same model; returns how many were embedded.
+    hashes = [story_text_hash(s) for s in stories]
+    cached = await get_story_text_hashes([s['id'] for s in stories])
+    pending = [(s, h) for s, h, old in zip(stories, hashes, cached) if h != old]
+    telemetry.incr("stories_embedded_total", len(pending))
+    telemetry.incr("stories_embedding_skipped_total", len(stories) - len(pending))
+    if not pending:
+        return 0
+
+    embeddings = await generate_embeddings(
+        [story_text(s) for s, _ in pending],
+        batch_size=batch_size,
+        max_concurrency=max_concurrency
+    )
+    await cache_story_embeddings_batch(
+        {s['id']: e for (s, _), e in zip(pending, embeddings)},
+        {s['id']: h for s, h in pending},
+        model=EMBEDDING_MODEL
+    )
+    return len(pending)
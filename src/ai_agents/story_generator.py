@@ -0,0 +1,244 @@
+import asyncio
+import hashlib
+import json
+from typing import Dict, List, Optional, Set, Union
+
+from src.dataclass import Story
+from src.ai_agents.open_ai import open_ai_agent
+from src.ai_agents.story_embeddings import embed_and_cache_stories
+from src.cache.redis import clear_generation_progress, get_generation_progress, save_generation_progress
+from src.telemetry import telemetry
+
+GENERATION_MODEL = "gpt-4o-mini"
+
+
+class StoryObjectStreamParser:
+    """Emits each JSON object of a streamed array as soon as its closing brace arrives.
+
+    Braces inside strings are ignored; an object that fails to parse is skipped without
+    losing the ones around it.
+    """
+
+    def __init__(self):
+        self._buffer: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> List[dict]:
+        objects = []
+        for ch in text:
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._buffer = [ch]
+                continue
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads("".join(self._buffer))
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        objects.append(obj)
+                    self._buffer = []
+        return objects
+
+
+def normalize_story(obj: dict) -> Optional[Story]:
+    try:
+        story = {
+            "id": int(obj["id"]),
+            "title": str(obj["title"]).strip(),
+            "intro": str(obj["intro"]).strip(),
+            "tags": [str(t).strip() for t in obj["tags"] if str(t).strip()],
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+    return story if story["title"] and story["tags"] else None
+
+
+def _title_key(title: str) -> str:
+    return " ".join(title.lower().split())
+
+
+class _PoolBuilder:
+    # De-duplicates stories across concurrently streaming chunks.
+
+    def __init__(self, seeds: List[Story], generated: List[Story]):
+        self.stories: List[Story] = list(generated)
+        self.ids: Set[int] = {int(s['id']) for s in seeds} | {int(s['id']) for s in generated}
+        self.titles: Set[str] = {_title_key(s['title']) for s in seeds} | {_title_key(s['title']) for s in generated}
+        self.duplicates = 0
+
+    def accept(self, story: Story) -> Optional[Story]:
+        title = _title_key(story['title'])
+        if title in self.titles:
+            self.duplicates += 1
+            return None
+        if story['id'] in self.ids:
+            # Parallel chunks can collide on IDs; keep the story under a fresh one.
+            story = dict(story, id=max(self.ids) + 1)
+        self.ids.add(story['id'])
+        self.titles.add(title)
+        self.stories.append(story)
+        return story
+
+
+def generation_run_id(seeds: List[Story], target_count: int, chunk_size: int) -> str:
+    payload = json.dumps([seeds, target_count, chunk_size, GENERATION_MODEL], sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+async def _generate_chunk(
+    seeds_text: str,
+    count: int,
+    start_id: int,
+    avoid_titles: List[str]
+):
+    system_prompt = (
+        "You are a story generator assistant. Given a small list of Sekai-style stories "
+        f"(each with id, title, intro, tags), write exactly {count} NEW stories in the same style. "
+        "Return EXACTLY a JSON array of story objects, where each object has the fields: "
+        "id (integer), title (string), intro (string), and tags (array of strings). "
+        "For speed and brevity, keep each intro to no more than 30 English words. "
+        f"Number the new stories consecutively starting at ID {start_id}. "
+        "Do NOT output any extra commentary—only the JSON array."
+    )
+    user_prompt = f"Seed Stories:\n{seeds_text}"
+    if avoid_titles:
+        user_prompt += f"\n\nTitles already used (do not repeat):\n{json.dumps(avoid_titles, ensure_ascii=False)}"
+
+    parser = StoryObjectStreamParser()
+    # Not retried mid-stream, since stories already yielded would repeat; a failed chunk is
+    # never checkpointed as done, so a re-run generates it again.
+    async with open_ai_agent.chat_stream(
+        model=GENERATION_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.7,
+        max_tokens=80 * count + 200
+    ) as deltas:
+        async for delta in deltas:
+            for obj in parser.feed(delta):
+                yield obj
+
+
+@telemetry.timed("generate_pool")
+async def generate_story_pool(
+    seeds: List[Story],
+    target_count: int,
+    chunk_size: int = 25,
+    max_concurrency: int = 8,
+    max_rounds: int = 3
+) -> List[Story]:
+    """Builds a pool of ``target_count`` stories (seeds included) from parallel streamed chunks.
+
+    Stories are embedded and cached in batches while generation is still running. Progress
+    is checkpointed in Redis under a run id derived from the inputs, so re-running after an
+    interruption skips finished chunks and keeps the stories already produced.
+    """
+    run_id = generation_run_id(seeds, target_count, chunk_size)
+    generated, done_chunks = await get_generation_progress(run_id)
+    builder = _PoolBuilder(seeds, generated)
+    seeds_text = json.dumps(seeds, ensure_ascii=False)
+    base_id = max(int(s['id']) for s in seeds) + 1
+
+    # Stories, then an int marking the end of that chunk, then None once generation stops.
+    queue: "asyncio.Queue[Union[Story, int, None]]" = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def embed_worker(batch_size: int = 100):
+        # Embeds and checkpoints stories while generation streams on. A chunk's end marker
+        # queues behind its stories, so a chunk is only saved as done with or after them.
+        finished = False
+        while not finished:
+            batch: List[Story] = []
+            done: List[int] = []
+            item = await queue.get()
+            while True:
+                if item is None:
+                    finished = True
+                    break
+                if isinstance(item, int):
+                    done.append(item)
+                else:
+                    batch.append(item)
+                if queue.empty() or len(batch) >= batch_size:
+                    break
+                item = queue.get_nowait()
+            if batch:
+                await embed_and_cache_stories(batch)
+            if batch or done:
+                await save_generation_progress(run_id, batch, done_chunks=done)
+
+    async def run_chunk(index: int, count: int):
+        async with semaphore:
+            if worker.done():
+                # The worker only stops early when it failed; this chunk could never be saved.
+                return
+            avoid = [s['title'] for s in builder.stories[-50:]]
+            async for obj in _generate_chunk(seeds_text, count, base_id + index * chunk_size, avoid):
+                story = normalize_story(obj)
+                if story is None:
+                    telemetry.incr("generated_stories_rejected_total", reason="malformed")
+                    continue
+                story = builder.accept(story)
+                if story is None:
+                    telemetry.incr("generated_stories_rejected_total", reason="duplicate")
+                    continue
+                await queue.put(story)
+            await queue.put(index)
+
+    worker = asyncio.create_task(embed_worker())
+    needed = target_count - len(seeds)
+    next_chunk = 0
+    try:
+        await embed_and_cache_stories(seeds)
+        for _ in range(max_rounds):
+            missing = needed - len(builder.stories)
+            if missing <= 0:
+                break
+            chunks: Dict[int, int] = {}
+            while missing > 0:
+                if next_chunk not in done_chunks:
+                    chunks[next_chunk] = min(chunk_size, missing)
+                    missing -= chunk_size
+                next_chunk += 1
+            tasks = [asyncio.ensure_future(run_chunk(i, n)) for i, n in chunks.items()]
+            generation = asyncio.gather(*tasks)
+            try:
+                await asyncio.wait({generation, worker}, return_when=asyncio.FIRST_COMPLETED)
+                if worker.done():
+                    # Nothing more can be embedded or checkpointed: raise its error now
+                    # instead of paying for the remaining chunks.
+                    worker.result()
+                await generation
+            except BaseException:
+                # Stop the other chunks before the worker is told generation is over.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(generation, return_exceptions=True)
+                raise
+    finally:
+        await queue.put(None)
+        await worker
+
+    pool = list(seeds) + builder.stories[:max(needed, 0)]
+    await clear_generation_progress(run_id)
+    return pool
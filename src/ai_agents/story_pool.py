@@ -0,0 +1,31 @@
+from typing import List, Optional, Sequence, Tuple
+
+from src.dataclass import Story
+from src.ai_agents.story_blocks import story_block_cache
+from src.ai_agents.story_embeddings import embed_and_cache_stories
+from src.ai_agents.story_generator import normalize_story
+from src.cache.redis import update_story_pool
+from src.telemetry import telemetry
+
+
+@telemetry.timed("update_pool")
+async def update_stories(
+    upserts: Sequence[dict] = (),
+    retire_ids: Sequence[int] = ()
+) -> Tuple[Optional[str], int]:
+    """Adds or replaces ``upserts`` and retires ``retire_ids`` without rebuilding the pool.
+
+    Only stories whose title, intro or tags changed are re-embedded. Embeddings are written
+    before the version bump, so a reader that sees the new version finds them. Returns the
+    new pool version and how many stories were embedded.
+    """
+    stories: List[Story] = []
+    for obj in upserts:
+        story = normalize_story(obj)
+        if story is None:
+            raise ValueError(f"story needs an id, title, intro and tags: {obj!r}")
+        stories.append(story)
+    embedded = await embed_and_cache_stories(stories) if stories else 0
+    version = await update_story_pool(stories, list(retire_ids))
+    story_block_cache.forget(retire_ids)
+    return version, embedded
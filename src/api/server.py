@@ -0,0 +1,137 @@
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from src.ai_agents.embedding_batcher import EmbeddingBatcher
+from src.ai_agents.evaluation import evaluate_for_user
+from src.ai_agents.open_ai import OpenAiAgent, open_ai_agent
+from src.ai_agents.recommend import EMBEDDING_MODEL, recommend_stories, set_query_embedder
+from src.cache.pool_matrix import pool_matrix_cache
+from src.cache.redis import close_redis, get_redis, get_redis_binary
+from src.retrieval.sharded import shutdown_executor
+from src.retrieval.tag_index import RETRIEVAL_MODES
+from src.telemetry import telemetry
+
+
+class RecommendRequest(BaseModel):
+    prompt: str
+    user_tags: List[str]
+    retrieval: Optional[str] = None
+
+
+class RecommendResponse(BaseModel):
+    story_ids: List[int]
+
+
+class EvaluateRequest(BaseModel):
+    prompt: str
+    user_profile: List[str]
+
+
+class EvaluateResponse(BaseModel):
+    precision: float
+    simulated_tags: List[str]
+    rec_ids: List[int]
+    gt_ids: List[int]
+
+
+class AppState:
+    def __init__(self):
+        self.batcher: Optional[EmbeddingBatcher] = None
+        self.latencies: Dict[str, Deque[float]] = {}
+
+
+state = AppState()
+
+
+async def require_story_pool():
+    # Requests rank against the cached matrix and hydrate only their candidates,
+    # so the full pool is never read here.
+    matrix = await pool_matrix_cache.get()
+    if not len(matrix.ids):
+        raise HTTPException(status_code=503, detail="story pool is empty; run main.py to build it")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await get_redis()
+    await get_redis_binary()
+    # Touch the shared client so its connection pool exists before the first request.
+    _ = open_ai_agent.async_client
+    state.batcher = EmbeddingBatcher(EMBEDDING_MODEL)
+    set_query_embedder(state.batcher.embed)
+    pool_matrix_cache.start_listener()
+    await pool_matrix_cache.get()
+    if pool_matrix_cache.sharded is not None:
+        await pool_matrix_cache.sharded.warm()
+    try:
+        yield
+    finally:
+        set_query_embedder(None)
+        await state.batcher.aclose()
+        await pool_matrix_cache.stop_listener()
+        pool_matrix_cache.close()
+        shutdown_executor()
+        await OpenAiAgent.aclose()
+        await close_redis()
+
+
+app = FastAPI(title="Sekai Story Recommendation", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    window = state.latencies.setdefault(request.url.path, deque(maxlen=10000))
+    window.append(time.perf_counter() - started)
+    return response
+
+
+@app.post("/recommend", response_model=RecommendResponse)
+async def recommend(body: RecommendRequest) -> RecommendResponse:
+    await require_story_pool()
+    if body.retrieval is not None and body.retrieval not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=422, detail=f"retrieval must be one of {list(RETRIEVAL_MODES)}")
+    story_ids = await recommend_stories(body.prompt, body.user_tags, retrieval=body.retrieval)
+    return RecommendResponse(story_ids=story_ids)
+
+
+@app.post("/evaluate", response_model=EvaluateResponse)
+async def evaluate(body: EvaluateRequest) -> EvaluateResponse:
+    await require_story_pool()
+    precision, detail = await evaluate_for_user(body.user_profile, body.prompt)
+    return EvaluateResponse(
+        precision=precision,
+        simulated_tags=detail["simulated_tags"],
+        rec_ids=detail["rec_ids"],
+        gt_ids=detail["gt_ids"]
+    )
+
+
+@app.get("/stats")
+async def stats() -> Dict[str, Dict[str, float]]:
+    out = {}
+    for path, window in state.latencies.items():
+        ordered = sorted(window)
+        out[path] = {
+            "count": len(ordered),
+            "p50_ms": ordered[int(0.50 * (len(ordered) - 1))] * 1000,
+            "p99_ms": ordered[int(0.99 * (len(ordered) - 1))] * 1000,
+        }
+    return out
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    return telemetry.export_prometheus()
+
+
+@app.get("/healthz")
+async def healthz() -> Dict[str, object]:
+    return {"status": "ok", "pool_version": pool_matrix_cache.version}
@@ -0,0 +1,55 @@
+import json
+import struct
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+# Binary layout (all little-endian):
+#   magic "SEMB" | version u8 | model tag length u8 | dim u32 | model tag | dim * float32
+MAGIC = b"SEMB"
+FORMAT_VERSION = 1
+DEFAULT_MODEL_TAG = "text-embedding-ada-002"
+
+_HEADER = struct.Struct("<4sBBI")
+_FLOAT32_LE = np.dtype("<f4")
+
+
+class EmbeddingFormatError(ValueError):
+    pass
+
+
+def encode_embedding(embedding: Sequence[float], model: str = DEFAULT_MODEL_TAG) -> bytes:
+    vector = np.ascontiguousarray(embedding, dtype=_FLOAT32_LE)
+    if vector.ndim != 1:
+        raise EmbeddingFormatError(f"expected a 1-d vector, got shape {vector.shape}")
+    tag = model.encode("utf-8")
+    if len(tag) > 255:
+        raise EmbeddingFormatError("model tag longer than 255 bytes")
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, len(tag), vector.shape[0]) + tag + vector.tobytes()
+
+
+def is_binary_embedding(payload: bytes) -> bool:
+    return payload[:4] == MAGIC
+
+
+def decode_embedding(payload: bytes) -> Tuple[np.ndarray, str]:
+    # Returns a read-only float32 view over ``payload`` (no copy) and its model tag.
+    if not is_binary_embedding(payload):
+        # Legacy JSON-encoded list written before the binary format existed.
+        return np.asarray(json.loads(payload), dtype=np.float32), ""
+    if len(payload) < _HEADER.size:
+        raise EmbeddingFormatError("truncated embedding header")
+    _, version, tag_len, dim = _HEADER.unpack_from(payload)
+    if version != FORMAT_VERSION:
+        raise EmbeddingFormatError(f"unsupported embedding format version {version}")
+    offset = _HEADER.size + tag_len
+    if len(payload) != offset + dim * _FLOAT32_LE.itemsize:
+        raise EmbeddingFormatError(f"payload size does not match dim {dim}")
+    model = payload[_HEADER.size:offset].decode("utf-8")
+    return np.frombuffer(payload, dtype=_FLOAT32_LE, count=dim, offset=offset), model
+
+
+def embedding_dim(payload: bytes) -> Optional[int]:
+    if not is_binary_embedding(payload) or len(payload) < _HEADER.size:
+        return None
+    return _HEADER.unpack_from(payload)[3]
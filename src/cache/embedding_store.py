@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.cache.embedding_codec import DEFAULT_MODEL_TAG
+from src.cache.redis import (
+    cache_story_embeddings_batch,
+    get_story_embedding_matrix,
+    get_story_ids,
+    get_story_pool_version,
+    get_story_text_hashes,
+)
+from src.retrieval.scoring import DimensionMismatch, EmbeddingMatrix, normalize_rows
+from src.telemetry import telemetry
+
+# "redis" reads every embedding over the network; "mmap" opens EMBEDDING_STORE_PATH instead.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "redis")
+EMBEDDING_STORE_PATH = os.getenv("EMBEDDING_STORE_PATH", ".cache/embeddings")
+
+_CURRENT = "CURRENT"
+
+
+class EmbeddingStore:
+    """Row-normalized float32 embeddings on disk, opened with ``np.memmap``.
+
+    Each snapshot is a directory holding ``vectors.npy`` (n x dim), an ``ids.npy`` sidecar
+    mapping rows to story ids, ``text_hashes.npy`` and ``meta.json``. A ``CURRENT`` file
+    names the live snapshot and is swapped with an atomic rename, so readers never see a
+    half-written one. Pages are mapped read-only, so every worker on the host shares a
+    single copy through the page cache, and opening costs the same at any pool size.
+    """
+
+    def __init__(self, path: str = EMBEDDING_STORE_PATH):
+        self.path = path
+
+    def current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, _CURRENT), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def meta(self) -> Optional[dict]:
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        with open(os.path.join(self.path, snapshot, "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def open(self) -> Optional[Tuple[EmbeddingMatrix, np.ndarray, dict]]:
+        # Returns the mapped matrix, its text hashes and the snapshot metadata.
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        directory = os.path.join(self.path, snapshot)
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        count = meta["count"]
+        if count == 0:
+            return EmbeddingMatrix([], np.empty((0, 0), dtype=np.float32), normalized=True), np.empty(0, "S40"), meta
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")[:count]
+        ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")[:count]
+        hashes = np.load(os.path.join(directory, "text_hashes.npy"), mmap_mode="r")[:count]
+        return EmbeddingMatrix(ids, vectors, normalized=True, copy=False), hashes, meta
+
+    def writer(self, capacity: int, dim: int) -> "EmbeddingStoreWriter":
+        return EmbeddingStoreWriter(self, capacity, dim)
+
+    def write(
+        self,
+        matrix: EmbeddingMatrix,
+        version: Optional[str],
+        model: str = DEFAULT_MODEL_TAG,
+        text_hashes: Optional[np.ndarray] = None
+    ) -> str:
+        writer = self.writer(len(matrix), matrix.dim if len(matrix) else 0)
+        writer.append(matrix.ids, matrix.vectors, text_hashes)
+        return writer.commit(version, model)
+
+    def _publish(self, snapshot: str, keep: int = 2):
+        pointer = os.path.join(self.path, f".{_CURRENT}.{os.getpid()}")
+        with open(pointer, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+        os.replace(pointer, os.path.join(self.path, _CURRENT))
+        # Older snapshots go; processes still mapping them keep their pages until they close.
+        snapshots = sorted(
+            (d for d in os.listdir(self.path) if d.startswith("snap-") and d != snapshot),
+            key=lambda d: os.path.getmtime(os.path.join(self.path, d)),
+            reverse=True
+        )
+        for stale in snapshots[keep - 1:]:
+            shutil.rmtree(os.path.join(self.path, stale), ignore_errors=True)
+
+
+class EmbeddingStoreWriter:
+    # Streams rows into a new snapshot so an export never holds the whole pool in memory.
+
+    def __init__(self, store: EmbeddingStore, capacity: int, dim: int):
+        os.makedirs(store.path, exist_ok=True)
+        self.store = store
+        # Written under a hidden name and renamed on commit, so cleanup never sees it half-done.
+        self.directory = tempfile.mkdtemp(prefix=".tmp-", dir=store.path)
+        self.dim = dim
+        self.count = 0
+        if capacity and dim:
+            self.vectors = np.lib.format.open_memmap(
+                os.path.join(self.directory, "vectors.npy"), mode="w+", dtype=np.float32, shape=(capacity, dim)
+            )
+        else:
+            self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.hashes = np.zeros(capacity, dtype="S40")
+
+    def append(self, ids, vectors: np.ndarray, text_hashes=None):
+        n = len(ids)
+        if n == 0:
+            return
+        end = self.count + n
+        self.vectors[self.count:end] = normalize_rows(vectors)
+        self.ids[self.count:end] = ids
+        if text_hashes is not None:
+            self.hashes[self.count:end] = [(h or "").encode("ascii") if isinstance(h, str) else (h or b"")
+                                           for h in text_hashes]
+        self.count = end
+
+    def commit(self, version: Optional[str], model: str = DEFAULT_MODEL_TAG) -> str:
+        if isinstance(self.vectors, np.memmap):
+            self.vectors.flush()
+        else:
+            np.save(os.path.join(self.directory, "vectors.npy"), self.vectors)
+        del self.vectors
+        np.save(os.path.join(self.directory, "ids.npy"), self.ids[:self.count])
+        np.save(os.path.join(self.directory, "text_hashes.npy"), self.hashes[:self.count])
+        with open(os.path.join(self.directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"count": self.count, "dim": self.dim, "version": version, "model": model}, f)
+        os.chmod(self.directory, 0o755)
+        snapshot = "snap-" + os.path.basename(self.directory)[len(".tmp-"):]
+        os.rename(self.directory, os.path.join(self.store.path, snapshot))
+        self.store._publish(snapshot)
+        return snapshot
+
+
+async def export_redis_embeddings(
+    path: str = EMBEDDING_STORE_PATH,
+    batch_size: int = 10000,
+    model: str = DEFAULT_MODEL_TAG
+) -> int:
+    """Snapshots the pool's ``story_embed:*`` keys into a store, one batch at a time."""
+    version = await get_story_pool_version()
+    story_ids = await get_story_ids()
+    writer = None
+    store = EmbeddingStore(path)
+    with telemetry.span("embedding_store.export"):
+        for start in range(0, len(story_ids), batch_size):
+            batch = story_ids[start:start + batch_size]
+            ids, vectors = await get_story_embedding_matrix(batch)
+            if not ids:
+                continue
+            if writer is None:
+                writer = store.writer(len(story_ids), vectors.shape[1])
+            hashes = await get_story_text_hashes(ids)
+            writer.append(ids, vectors, hashes)
+        if writer is None:
+            writer = store.writer(0, 0)
+        writer.commit(version, model)
+    return writer.count
+
+
+async def import_redis_embeddings(path: str = EMBEDDING_STORE_PATH, batch_size: int = 1000) -> int:
+    """Writes a store's rows back into ``story_embed:*`` (with their text hashes)."""
+    opened = EmbeddingStore(path).open()
+    if opened is None:
+        return 0
+    matrix, hashes, meta = opened
+    with telemetry.span("embedding_store.import"):
+        for start in range(0, len(matrix), batch_size):
+            ids = matrix.ids[start:start + batch_size].tolist()
+            rows = matrix.vectors[start:start + batch_size]
+            batch_hashes = [h.decode("ascii") for h in hashes[start:start + batch_size]]
+            await cache_story_embeddings_batch(
+                dict(zip(ids, rows)),
+                {story_id: h for story_id, h in zip(ids, batch_hashes) if h},
+                model=meta.get("model") or DEFAULT_MODEL_TAG
+            )
+    return len(matrix)
+
+
+def _write_delta(
+    store: EmbeddingStore,
+    ids: Sequence[int],
+    vectors: np.ndarray,
+    text_hashes: List[Optional[str]],
+    removed: Sequence[int],
+    version: Optional[str],
+    batch_size: int
+) -> bool:
+    opened = store.open()
+    if opened is None:
+        return False
+    base, hashes, meta = opened
+    if len(ids) and len(base) and vectors.shape[1] != base.dim:
+        raise DimensionMismatch(f"delta has dim {vectors.shape[1]}, store has {base.dim}")
+    # Replaced rows are dropped from the old snapshot and written again at the end.
+    dropped = np.asarray(sorted({int(i) for i in removed} | {int(i) for i in ids}), dtype=np.int64)
+    kept = ~np.isin(base.ids, dropped)
+    dim = base.dim if len(base) else (vectors.shape[1] if len(ids) else 0)
+    writer = store.writer(int(kept.sum()) + len(ids), dim)
+    for start in range(0, len(base), batch_size):
+        keep = kept[start:start + batch_size]
+        writer.append(
+            base.ids[start:start + batch_size][keep],
+            base.vectors[start:start + batch_size][keep],
+            hashes[start:start + batch_size][keep]
+        )
+    writer.append(list(ids), vectors, text_hashes)
+    writer.commit(version, meta.get("model") or DEFAULT_MODEL_TAG)
+    return True
+
+
+async def write_store_delta(
+    ids: Sequence[int],
+    vectors: np.ndarray,
+    removed: Sequence[int],
+    version: Optional[str],
+    path: str = EMBEDDING_STORE_PATH,
+    batch_size: int = 65536
+) -> bool:
+    """Publishes the current snapshot with ``ids`` upserted and ``removed`` dropped.
+
+    Untouched rows are streamed from the old snapshot, so only the delta is read from Redis.
+    Returns False when there is no snapshot to start from.
+    """
+    text_hashes = await get_story_text_hashes(list(ids))
+    with telemetry.span("embedding_store.delta"):
+        return await asyncio.to_thread(
+            _write_delta, EmbeddingStore(path), ids, vectors, text_hashes, removed, version, batch_size
+        )
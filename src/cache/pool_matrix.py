@@ -0,0 +1,277 @@
+import asyncio
+import os
+from typing import List, Optional, Set, Tuple
+
+from src.cache.embedding_store import (
+    EMBEDDING_BACKEND,
+    EMBEDDING_STORE_PATH,
+    EmbeddingStore,
+    export_redis_embeddings,
+    write_store_delta,
+)
+from src.cache.redis import (
+    STORY_POOL_CHANNEL,
+    get_redis,
+    get_story_embedding_matrix,
+    get_stories,
+    get_story_ids,
+    get_story_pool_changes,
+    get_story_pool_version,
+    iter_story_pool,
+)
+from src.retrieval.ivf import ANN_MIN_POOL_SIZE, IvfFlatIndex, load_or_build_index
+from src.retrieval.quantized import PREFILTER_COMPRESSION, CompressedIndex
+from src.retrieval.scoring import DimensionMismatch, EmbeddingMatrix
+from src.retrieval.sharded import SCORING_WORKERS, SHARDED_MIN_POOL_SIZE, ShardedScorer
+from src.retrieval.tag_index import TagIndex
+from src.telemetry import telemetry
+
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH", ".cache/ann_index")
+# Longest chain of pool deltas patched in place before falling back to a full reload.
+MAX_DELTA_CHAIN = int(os.getenv("POOL_MAX_DELTA_CHAIN", 32))
+
+
+class PoolMatrixCache:
+    """Process-local copy of the story embedding matrix, reloaded only when the pool version changes.
+
+    Without a listener every lookup costs one GET of the small version key. With
+    ``start_listener`` running, the version is trusted until a pub/sub notification
+    marks it stale, so lookups make no Redis calls at all.
+    """
+
+    def __init__(self):
+        self.version: Optional[str] = None
+        self.matrix: Optional[EmbeddingMatrix] = None
+        self.ann_index: Optional[IvfFlatIndex] = None
+        self.compressed: Optional[CompressedIndex] = None
+        self.sharded: Optional[ShardedScorer] = None
+        self._retired_sharded: Optional[ShardedScorer] = None
+        self.tag_index: Optional[TagIndex] = None
+        self._tag_index_version: Optional[str] = None
+        self._stale = True
+        self._lock: Optional[asyncio.Lock] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    @property
+    def search_index(self):
+        # What the prefilter searches instead of the exact scan, if anything.
+        return self.ann_index if self.ann_index is not None else self.compressed
+
+    def invalidate(self):
+        self._stale = True
+
+    async def get(self) -> EmbeddingMatrix:
+        if self.matrix is not None and self._listener is not None and not self._stale:
+            telemetry.record_cache("pool_matrix", True)
+            return self.matrix
+        version = await get_story_pool_version()
+        if self.matrix is not None and version == self.version:
+            self._stale = False
+            telemetry.record_cache("pool_matrix", True)
+            return self.matrix
+        telemetry.record_cache("pool_matrix", False)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.matrix is None or version != self.version:
+                delta = await self._pending_delta(version) if self.matrix is not None else None
+                patched = None
+                if delta is not None:
+                    try:
+                        with telemetry.span("pool_matrix.patch"):
+                            patched = await self._patch(*delta, version)
+                        telemetry.incr("pool_matrix_patches_total")
+                    except DimensionMismatch:
+                        # e.g. the embedding model changed the dimension; start over.
+                        patched = None
+                if patched is not None:
+                    matrix, ann_index, compressed, tag_index = patched
+                else:
+                    with telemetry.span("pool_matrix.reload"):
+                        matrix = await self._load(version)
+                    ann_index = await self._load_index(matrix, version)
+                    compressed = await self._load_compressed(matrix, ann_index)
+                    tag_index = None
+                sharded = await self._load_sharded(matrix)
+                # Swap everything together so readers never pair a matrix with another matrix's index.
+                self.matrix, self.ann_index, self.compressed, self.version = matrix, ann_index, compressed, version
+                self._retire_sharded(sharded)
+                self.tag_index, self._tag_index_version = tag_index, version if tag_index is not None else None
+            self._stale = False
+        return self.matrix
+
+    async def get_tag_index(self) -> TagIndex:
+        # Built on first use per pool version, so dense-only callers never pay for it.
+        await self.get()
+        version = self.version
+        if self.tag_index is None or self._tag_index_version != version:
+            with telemetry.span("pool_matrix.tag_index"):
+                ids: List[int] = []
+                tags: List[List[str]] = []
+                async for page in iter_story_pool():
+                    for story in page:
+                        ids.append(story['id'])
+                        tags.append(story['tags'])
+                tag_index = await asyncio.to_thread(TagIndex, ids, tags)
+            self.tag_index, self._tag_index_version = tag_index, version
+        return self.tag_index
+
+    async def _pending_delta(self, version: Optional[str]) -> Optional[Tuple[Set[int], Set[int]]]:
+        # Walks the change records back from ``version`` to the one held here and folds them
+        # into one net (upserted, retired) pair; None means a full reload is needed.
+        chain = []
+        while version != self.version:
+            if version is None or len(chain) >= MAX_DELTA_CHAIN:
+                return None
+            changes = await get_story_pool_changes(version)
+            if changes is None:
+                return None
+            chain.append(changes)
+            version = changes["base"]
+        upserted: Set[int] = set()
+        retired: Set[int] = set()
+        for changes in reversed(chain):
+            upserted.difference_update(changes["retired"])
+            retired.update(changes["retired"])
+            retired.difference_update(changes["upserted"])
+            upserted.update(changes["upserted"])
+        return upserted, retired
+
+    async def _patch(
+        self,
+        upserted: Set[int],
+        retired: Set[int],
+        version: Optional[str]
+    ) -> Tuple[EmbeddingMatrix, Optional[IvfFlatIndex], Optional[CompressedIndex], Optional[TagIndex]]:
+        # Only the changed stories' embeddings are read; untouched rows are reused.
+        story_ids, vectors = await get_story_embedding_matrix(sorted(upserted))
+        # An upserted story without an embedding must not keep its stale row.
+        removed = retired | (upserted - set(story_ids))
+        if EMBEDDING_BACKEND == "mmap":
+            matrix = await self._patch_store(story_ids, vectors, sorted(removed), version)
+        else:
+            matrix = self.matrix.updated(story_ids, vectors, sorted(removed))
+        if (self.ann_index is None or self.ann_index.needs_retrain() or len(matrix) < ANN_MIN_POOL_SIZE
+                or self._shards(matrix)):
+            ann_index = await self._load_index(matrix, version)
+        else:
+            ann_index = await asyncio.to_thread(self.ann_index.updated, matrix, story_ids)
+            if ann_index.needs_retrain():
+                ann_index = await self._load_index(matrix, version)
+            else:
+                await asyncio.to_thread(ann_index.save, ANN_INDEX_PATH, version)
+        if (ann_index is None and self.compressed is not None and self.compressed.matrix.dim == matrix.dim
+                and not self._shards(matrix)):
+            compressed = await asyncio.to_thread(self.compressed.updated, matrix, story_ids)
+        else:
+            compressed = await self._load_compressed(matrix, ann_index)
+        tag_index = None
+        if self.tag_index is not None and self._tag_index_version == self.version:
+            stories = [s for s in await get_stories(sorted(upserted)) if s is not None]
+            tag_index = await asyncio.to_thread(self.tag_index.updated, stories, sorted(retired))
+        return matrix, ann_index, compressed, tag_index
+
+    async def _patch_store(
+        self,
+        story_ids: List[int],
+        vectors,
+        removed: List[int],
+        version: Optional[str]
+    ) -> EmbeddingMatrix:
+        # Patching a mapped matrix in memory would leave every worker with a private copy, so
+        # a new snapshot is published and mapped instead. Another worker on the host may have
+        # published it already; a snapshot from neither version means starting over.
+        store = EmbeddingStore(EMBEDDING_STORE_PATH)
+        meta = await asyncio.to_thread(store.meta)
+        snapshot_version = meta.get("version") if meta is not None else None
+        if meta is None or snapshot_version not in (self.version, version):
+            return await self._load(version)
+        if snapshot_version != version:
+            await write_store_delta(story_ids, vectors, removed, version, EMBEDDING_STORE_PATH)
+        opened = await asyncio.to_thread(store.open)
+        return opened[0] if opened is not None else await self._load(version)
+
+    async def _load(self, version: Optional[str]) -> EmbeddingMatrix:
+        if EMBEDDING_BACKEND == "mmap":
+            # Map the on-disk snapshot; only a stale or missing one is re-exported from Redis first.
+            store = EmbeddingStore(EMBEDDING_STORE_PATH)
+            meta = await asyncio.to_thread(store.meta)
+            if meta is None or meta.get("version") != version:
+                await export_redis_embeddings(EMBEDDING_STORE_PATH)
+            opened = await asyncio.to_thread(store.open)
+            if opened is not None:
+                return opened[0]
+        story_ids, vectors = await get_story_embedding_matrix(await get_story_ids())
+        return EmbeddingMatrix(story_ids, vectors, copy=False)
+
+    async def _load_index(self, matrix: EmbeddingMatrix, version: Optional[str]) -> Optional[IvfFlatIndex]:
+        # Small pools are scanned exactly; the index only pays off for large ones.
+        if len(matrix) < ANN_MIN_POOL_SIZE or self._shards(matrix):
+            return None
+        return await asyncio.to_thread(load_or_build_index, matrix, ANN_INDEX_PATH, version)
+
+    async def _load_compressed(
+        self,
+        matrix: EmbeddingMatrix,
+        ann_index: Optional[IvfFlatIndex]
+    ) -> Optional[CompressedIndex]:
+        # Only used when enabled and no ANN index is in play; the projection is refitted here.
+        if not PREFILTER_COMPRESSION or ann_index is not None or len(matrix) == 0 or self._shards(matrix):
+            return None
+        with telemetry.span("pool_matrix.compress", mode=PREFILTER_COMPRESSION):
+            return await asyncio.to_thread(CompressedIndex, matrix, PREFILTER_COMPRESSION)
+
+    @staticmethod
+    def _shards(matrix: EmbeddingMatrix) -> bool:
+        # Exact sharded scoring, once enabled, takes over from the ANN and compressed indexes.
+        return SCORING_WORKERS > 0 and len(matrix) >= SHARDED_MIN_POOL_SIZE
+
+    async def _load_sharded(self, matrix: EmbeddingMatrix) -> Optional[ShardedScorer]:
+        if not self._shards(matrix):
+            return None
+        with telemetry.span("pool_matrix.share"):
+            return await asyncio.to_thread(ShardedScorer, matrix, SCORING_WORKERS)
+
+    def _retire_sharded(self, sharded: Optional[ShardedScorer]):
+        # The replaced scorer's segment lives one more generation, so searches already
+        # dispatched against it can still attach.
+        if self._retired_sharded is not None:
+            self._retired_sharded.close()
+        self._retired_sharded, self.sharded = self.sharded, sharded
+
+    def close(self):
+        for sharded in (self.sharded, self._retired_sharded):
+            if sharded is not None:
+                sharded.close()
+        self.sharded = self._retired_sharded = None
+
+    def start_listener(self) -> asyncio.Task:
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        return self._listener
+
+    async def stop_listener(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        self.invalidate()
+
+    async def _listen(self):
+        r = await get_redis()
+        pubsub = r.pubsub()
+        await pubsub.subscribe(STORY_POOL_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") == "message" and message.get("data") != self.version:
+                    self.invalidate()
+        finally:
+            self.invalidate()
+            await pubsub.unsubscribe(STORY_POOL_CHANNEL)
+            await pubsub.close()
+
+
+pool_matrix_cache = PoolMatrixCache()
@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Sequence
+
+import numpy as np
+
+from src.cache.redis import cache_query_embedding, get_query_embedding
+from src.telemetry import telemetry
+
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", 4096))
+QUERY_EMBED_TTL_SECONDS = int(os.getenv("QUERY_EMBED_TTL_SECONDS", 7 * 24 * 3600))
+
+
+def canonical_tags(tags: Sequence[str]) -> List[str]:
+    return sorted({" ".join(tag.lower().split()) for tag in tags if tag.strip()})
+
+
+class QueryEmbeddingCache:
+    """Two-tier cache for query embeddings: a bounded in-process LRU in front of Redis (with TTL)."""
+
+    def __init__(self, max_size: int = QUERY_EMBED_CACHE_SIZE, ttl_seconds: int = QUERY_EMBED_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tags: Sequence[str], model: str) -> str:
+        text = "\n".join(canonical_tags(tags))
+        return hashlib.sha1(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    async def get(
+        self,
+        tags: Sequence[str],
+        model: str,
+        embed: Callable[[str], Awaitable[List[float]]]
+    ) -> np.ndarray:
+        key = self.key(tags, model)
+        embedding = self._lru.get(key)
+        if embedding is not None:
+            self._lru.move_to_end(key)
+            self.local_hits += 1
+            telemetry.record_cache("query_embedding_local", True)
+            return embedding
+
+        # Concurrent misses on the same tag set share one lookup/embedding call. It runs in a
+        # task owned by the cache, so a cancelled caller does not cancel it for the others.
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, tags, model, embed))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._settle(key, t))
+        return await asyncio.shield(task)
+
+    async def _fetch(
+        self,
+        key: str,
+        tags: Sequence[str],
+        model: str,
+        embed: Callable[[str], Awaitable[List[float]]]
+    ) -> np.ndarray:
+        telemetry.record_cache("query_embedding_local", False)
+        embedding = await get_query_embedding(key)
+        telemetry.record_cache("query_embedding_redis", embedding is not None)
+        if embedding is not None:
+            self.redis_hits += 1
+        else:
+            self.misses += 1
+            embedding = np.asarray(await embed(" ".join(canonical_tags(tags))), dtype=np.float32)
+            await cache_query_embedding(key, embedding, model, self.ttl_seconds)
+        self._remember(key, embedding)
+        return embedding
+
+    def _settle(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Every waiter may have gone; mark the exception as retrieved.
+            task.exception()
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "size": len(self._lru),
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+        }
+
+
+query_embedding_cache = QueryEmbeddingCache()
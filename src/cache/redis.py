@@ -1,9 +1,20 @@
 import os
-from typing import Optional, List
+import hashlib
+from typing import AsyncIterator, Optional, List, Sequence, Tuple, Dict
 import json
+import numpy as np
 from src.dataclass import Story
+from src.telemetry import telemetry
+from src.cache.embedding_codec import (
+    DEFAULT_MODEL_TAG,
+    decode_embedding,
+    embedding_dim,
+    encode_embedding,
+    is_binary_embedding,
+)
 
 import redis.asyncio as aioredis
+from redis.exceptions import WatchError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,7 +23,17 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB   = int(os.getenv("REDIS_DB", 0))
 
+# Legacy single-blob pool key; only read to migrate older caches.
+STORY_POOL_KEY = "story_pool"
+STORY_IDS_KEY = "story_ids"
+STORY_POOL_VERSION_KEY = "story_pool:version"
+STORY_POOL_CHANNEL = "story_pool:updates"
+STORY_EMBED_HASHES_KEY = "story_embed_hashes"
+# How long a delta stays readable for caches that want to patch instead of reload.
+STORY_POOL_CHANGES_TTL = int(os.getenv("STORY_POOL_CHANGES_TTL", 86400))
+
 _redis_client: Optional[aioredis.Redis] = None
+_redis_binary_client: Optional[aioredis.Redis] = None
 
 async def get_redis() -> aioredis.Redis:
     global _redis_client
@@ -26,42 +47,339 @@ async def get_redis() -> aioredis.Redis:
         )
     return _redis_client
 
+async def get_redis_binary() -> aioredis.Redis:
+    # Embeddings are raw float32 bytes, so they need a connection that does not decode.
+    global _redis_binary_client
+    if not _redis_binary_client:
+        _redis_binary_client = aioredis.Redis(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB,
+            decode_responses=False
+        )
+    return _redis_binary_client
+
+def use_redis_clients(client: aioredis.Redis, binary_client: aioredis.Redis):
+    # Point the cache layer at other connections (e.g. fakeredis) sharing one keyspace.
+    global _redis_client, _redis_binary_client
+    _redis_client = client
+    _redis_binary_client = binary_client
+
+def _size(*values) -> int:
+    return sum(len(v) for v in values if v)
+
+async def close_redis():
+    global _redis_client, _redis_binary_client
+    for client in (_redis_client, _redis_binary_client):
+        if client is not None:
+            await client.close()
+    _redis_client = None
+    _redis_binary_client = None
+
 async def cache_user_prompt(user_id: str, prompt_text: str):
     r = await get_redis()
     key = f"prompt:{user_id}"
     await r.set(key, prompt_text)
+    telemetry.record_redis("set_prompt", _size(prompt_text))
 
 async def get_user_prompt(user_id: str) -> Optional[str]:
     r = await get_redis()
     key = f"prompt:{user_id}"
-    return await r.get(key)
+    data = await r.get(key)
+    telemetry.record_redis("get_prompt", _size(data))
+    return data
 
-async def cache_story_embeddings(story_id: int, embedding: List[float]):
+async def cache_ground_truth(profile_hash: str, story_ids: List[int], ttl_seconds: Optional[int] = None):
     r = await get_redis()
+    key = f"gt:{profile_hash}"
+    data = json.dumps(story_ids)
+    await r.set(key, data, ex=ttl_seconds)
+    telemetry.record_redis("set_ground_truth", _size(data))
+
+async def get_ground_truth(profile_hash: str) -> Optional[List[int]]:
+    r = await get_redis()
+    key = f"gt:{profile_hash}"
+    data = await r.get(key)
+    telemetry.record_redis("get_ground_truth", _size(data))
+    return json.loads(data) if data else None
+
+async def cache_tag_samples(profile_hash: str, samples: List[List[str]], ttl_seconds: Optional[int] = None):
+    r = await get_redis()
+    key = f"tag_samples:{profile_hash}"
+    data = json.dumps(samples, ensure_ascii=False)
+    await r.set(key, data, ex=ttl_seconds)
+    telemetry.record_redis("set_tag_samples", _size(data))
+
+async def get_tag_samples(profile_hash: str) -> Optional[List[List[str]]]:
+    r = await get_redis()
+    key = f"tag_samples:{profile_hash}"
+    data = await r.get(key)
+    telemetry.record_redis("get_tag_samples", _size(data))
+    return json.loads(data) if data else None
+
+async def cache_query_embedding(query_hash: str, embedding: List[float], model: str, ttl_seconds: int):
+    r = await get_redis_binary()
+    key = f"query_embed:{query_hash}"
+    data = encode_embedding(embedding, model)
+    await r.set(key, data, ex=ttl_seconds)
+    telemetry.record_redis("set_query_embedding", _size(data))
+
+async def get_query_embedding(query_hash: str) -> Optional[np.ndarray]:
+    r = await get_redis_binary()
+    key = f"query_embed:{query_hash}"
+    data = await r.get(key)
+    telemetry.record_redis("get_query_embedding", _size(data))
+    return decode_embedding(data)[0] if data else None
+
+async def cache_story_embeddings(story_id: int, embedding: List[float], model: str = DEFAULT_MODEL_TAG):
+    r = await get_redis_binary()
     key = f"story_embed:{story_id}"
-    await r.set(key, json.dumps(embedding))
+    data = encode_embedding(embedding, model)
+    await r.set(key, data)
+    telemetry.record_redis("set_story_embedding", _size(data))
+
+async def cache_story_embeddings_batch(
+    embeddings: Dict[int, List[float]],
+    text_hashes: Optional[Dict[int, str]] = None,
+    model: str = DEFAULT_MODEL_TAG
+):
+    # One MSET for the vectors plus one HSET for their source-text hashes, in a single round trip.
+    if not embeddings:
+        return
+    r = await get_redis_binary()
+    pipeline = r.pipeline(transaction=False)
+    payloads = {
+        f"story_embed:{story_id}": encode_embedding(embedding, model)
+        for story_id, embedding in embeddings.items()
+    }
+    pipeline.mset(payloads)
+    if text_hashes:
+        pipeline.hset(STORY_EMBED_HASHES_KEY, mapping={str(k): v for k, v in text_hashes.items()})
+    await pipeline.execute()
+    telemetry.record_redis("set_story_embeddings_batch", _size(*payloads.values()))
 
-async def get_story_embedding(story_id: int) -> Optional[List[float]]:
+async def get_story_text_hashes(story_ids: List[int]) -> List[Optional[str]]:
+    if not story_ids:
+        return []
     r = await get_redis()
+    hashes = await r.hmget(STORY_EMBED_HASHES_KEY, [str(story_id) for story_id in story_ids])
+    telemetry.record_redis("get_story_text_hashes", _size(*hashes))
+    return hashes
+
+async def get_story_embedding(story_id: int) -> Optional[np.ndarray]:
+    r = await get_redis_binary()
     key = f"story_embed:{story_id}"
     data = await r.get(key)
+    telemetry.record_redis("get_story_embedding", _size(data))
+    return decode_embedding(data)[0] if data else None
+
+def story_pool_version(serialized_pool: str) -> str:
+    return hashlib.sha1(serialized_pool.encode("utf-8")).hexdigest()
+
+def _story_record(story: Story) -> str:
+    return json.dumps(story, ensure_ascii=False)
+
+async def cache_story_pool(stories: List[Story], batch_size: int = 1000):
+    # Stories live under story:<id> with a sorted id index, so readers can hydrate only
+    # the ids they need. Records are written first; the index, removals, version bump
+    # and announcement then land in one transaction so a new version is never visible
+    # before its stories are.
+    r = await get_redis()
+    version = story_pool_version(json.dumps(stories))
+    new_ids = {int(s['id']) for s in stories}
+    old_ids = {int(i) for i in await r.zrange(STORY_IDS_KEY, 0, -1)}
+    written = 0
+    for start in range(0, len(stories), batch_size):
+        records = {f"story:{s['id']}": _story_record(s) for s in stories[start:start + batch_size]}
+        await r.mset(records)
+        written += _size(*records.values())
+    removed = old_ids - new_ids
+    pipeline = r.pipeline(transaction=True)
+    if stories:
+        pipeline.zadd(STORY_IDS_KEY, {str(story_id): story_id for story_id in new_ids})
+    if removed:
+        pipeline.zrem(STORY_IDS_KEY, *[str(i) for i in removed])
+        pipeline.delete(*[f"story:{i}" for i in removed])
+    pipeline.delete(STORY_POOL_KEY)
+    pipeline.set(STORY_POOL_VERSION_KEY, version)
+    pipeline.publish(STORY_POOL_CHANNEL, version)
+    await pipeline.execute()
+    telemetry.record_redis("set_story_pool", written, round_trips=2 + (len(stories) - 1) // batch_size + 1)
+
+async def update_story_pool(upserts: List[Story] = (), retired_ids: List[int] = ()) -> Optional[str]:
+    # Applies a delta without rewriting the pool. The new version chains off the current one
+    # under WATCH, so concurrent updates serialize; a change record lets process-local caches
+    # patch their copy instead of reloading everything.
+    r = await get_redis()
+    if not await r.exists(STORY_IDS_KEY):
+        await _migrate_story_pool_blob(r)
+    upserts = list({int(s['id']): s for s in upserts}.values())
+    upserted = [int(s['id']) for s in upserts]
+    retired = sorted({int(i) for i in retired_ids} - set(upserted))
+    if not upserts and not retired:
+        return await get_story_pool_version()
+    written = 0
+    if upserts:
+        records = {f"story:{s['id']}": _story_record(s) for s in upserts}
+        await r.mset(records)
+        written = _size(*records.values())
+    delta = json.dumps({"upsert": upserts, "retire": retired}, ensure_ascii=False, sort_keys=True)
+    async with r.pipeline(transaction=True) as pipeline:
+        while True:
+            try:
+                await pipeline.watch(STORY_POOL_VERSION_KEY)
+                base = await pipeline.get(STORY_POOL_VERSION_KEY)
+                version = story_pool_version(f"{base}:{delta}")
+                pipeline.multi()
+                if upserted:
+                    pipeline.zadd(STORY_IDS_KEY, {str(story_id): story_id for story_id in upserted})
+                if retired:
+                    pipeline.zrem(STORY_IDS_KEY, *[str(i) for i in retired])
+                    pipeline.delete(*[f"story:{i}" for i in retired], *[f"story_embed:{i}" for i in retired])
+                    pipeline.hdel(STORY_EMBED_HASHES_KEY, *[str(i) for i in retired])
+                pipeline.set(
+                    f"story_pool:changes:{version}",
+                    json.dumps({"base": base, "upserted": upserted, "retired": retired}),
+                    ex=STORY_POOL_CHANGES_TTL
+                )
+                pipeline.set(STORY_POOL_VERSION_KEY, version)
+                pipeline.publish(STORY_POOL_CHANNEL, version)
+                await pipeline.execute()
+                break
+            except WatchError:
+                continue
+    telemetry.record_redis("update_story_pool", written, round_trips=4)
+    return version
+
+async def get_story_pool_changes(version: str) -> Optional[Dict]:
+    r = await get_redis()
+    data = await r.get(f"story_pool:changes:{version}")
+    telemetry.record_redis("get_story_pool_changes", _size(data))
     return json.loads(data) if data else None
 
-async def cache_story_pool(stories: List[Story]):
+async def _migrate_story_pool_blob(r: aioredis.Redis) -> bool:
+    # Pools cached as one story_pool JSON blob are sharded on first read.
+    data = await r.get(STORY_POOL_KEY)
+    if not data:
+        return False
+    await cache_story_pool(json.loads(data))
+    return True
+
+async def get_story_ids() -> List[int]:
+    r = await get_redis()
+    ids = await r.zrange(STORY_IDS_KEY, 0, -1)
+    telemetry.record_redis("get_story_ids", _size(*ids))
+    if not ids and await _migrate_story_pool_blob(r):
+        ids = await r.zrange(STORY_IDS_KEY, 0, -1)
+    return [int(i) for i in ids]
+
+async def get_stories(story_ids: List[int]) -> List[Optional[Story]]:
+    if not story_ids:
+        return []
     r = await get_redis()
-    await r.set("story_pool", json.dumps(stories))
+    records = await r.mget([f"story:{story_id}" for story_id in story_ids])
+    telemetry.record_redis("get_stories", _size(*records))
+    return [json.loads(record) if record else None for record in records]
+
+async def iter_story_pool(page_size: int = 1000) -> AsyncIterator[List[Story]]:
+    # Pages follow the sorted id index; each page is one ZRANGE plus one MGET.
+    r = await get_redis()
+    if not await r.exists(STORY_IDS_KEY):
+        await _migrate_story_pool_blob(r)
+    start = 0
+    while True:
+        ids = await r.zrange(STORY_IDS_KEY, start, start + page_size - 1)
+        telemetry.record_redis("get_story_ids", _size(*ids))
+        if not ids:
+            return
+        stories = await get_stories([int(i) for i in ids])
+        yield [s for s in stories if s is not None]
+        start += page_size
 
 async def get_story_pool() -> Optional[List[Story]]:
+    stories: List[Story] = []
+    async for page in iter_story_pool():
+        stories.extend(page)
+    return stories or None
+
+async def get_story_pool_version() -> Optional[str]:
     r = await get_redis()
-    data = await r.get("story_pool")
-    return json.loads(data) if data else None
+    version = await r.get(STORY_POOL_VERSION_KEY)
+    telemetry.record_redis("get_story_pool_version", _size(version))
+    if version:
+        return version
+    # Pools cached before versioning existed: derive the version once and store it.
+    data = await r.get(STORY_POOL_KEY)
+    if not data:
+        return None
+    version = story_pool_version(data)
+    await r.set(STORY_POOL_VERSION_KEY, version, nx=True)
+    return version
+
+async def save_generation_progress(run_id: str, stories: List[Story] = (), done_chunks: Sequence[int] = ()):
+    # One transaction, so chunks are never marked done without the stories saved with them.
+    r = await get_redis()
+    pipeline = r.pipeline(transaction=True)
+    if stories:
+        pipeline.hset(f"story_gen:{run_id}:stories", mapping={
+            str(story['id']): json.dumps(story, ensure_ascii=False) for story in stories
+        })
+    if done_chunks:
+        pipeline.sadd(f"story_gen:{run_id}:chunks", *done_chunks)
+    await pipeline.execute()
+    telemetry.record_redis("save_generation_progress")
 
-async def get_story_embeddings_batch(story_ids: List[int]) -> List[Optional[List[float]]]:
+async def get_generation_progress(run_id: str) -> Tuple[List[Story], List[int]]:
     r = await get_redis()
+    pipeline = r.pipeline(transaction=False)
+    pipeline.hvals(f"story_gen:{run_id}:stories")
+    pipeline.smembers(f"story_gen:{run_id}:chunks")
+    stories, chunks = await pipeline.execute()
+    telemetry.record_redis("get_generation_progress", _size(*stories))
+    return [json.loads(s) for s in stories], sorted(int(c) for c in chunks)
+
+async def clear_generation_progress(run_id: str):
+    r = await get_redis()
+    await r.delete(f"story_gen:{run_id}:stories", f"story_gen:{run_id}:chunks")
+    telemetry.record_redis("clear_generation_progress")
+
+async def _fetch_story_embeddings(story_ids: List[int]) -> List[Optional[bytes]]:
+    r = await get_redis_binary()
     pipeline = r.pipeline()
     for story_id in story_ids:
         key = f"story_embed:{story_id}"
         pipeline.get(key)
-    
     results = await pipeline.execute()
-    return [json.loads(data) if data else None for data in results]
\ No newline at end of file
+    telemetry.record_redis("get_story_embeddings_batch", _size(*results))
+    return results
+
+async def get_story_embeddings_batch(story_ids: List[int]) -> List[Optional[np.ndarray]]:
+    results = await _fetch_story_embeddings(story_ids)
+    return [decode_embedding(data)[0] if data else None for data in results]
+
+async def get_story_embedding_matrix(story_ids: List[int]) -> Tuple[List[int], np.ndarray]:
+    results = await _fetch_story_embeddings(story_ids)
+    present = [(story_id, data) for story_id, data in zip(story_ids, results) if data]
+    if not present:
+        return [], np.empty((0, 0), dtype=np.float32)
+    dim = embedding_dim(present[0][1]) or len(decode_embedding(present[0][1])[0])
+    matrix = np.empty((len(present), dim), dtype=np.float32)
+    for row, (_, data) in enumerate(present):
+        matrix[row] = decode_embedding(data)[0]
+    return [story_id for story_id, _ in present], matrix
+
+async def migrate_story_embeddings(batch_size: int = 500) -> int:
+    # One-shot rewrite of legacy JSON `story_embed:*` values into the binary format.
+    r = await get_redis_binary()
+    migrated = 0
+    keys = [key async for key in r.scan_iter(match="story_embed:*", count=batch_size)]
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        values = await r.mget(chunk)
+        pipeline = r.pipeline()
+        for key, data in zip(chunk, values):
+            if data and not is_binary_embedding(data):
+                pipeline.set(key, encode_embedding(json.loads(data)))
+                migrated += 1
+        await pipeline.execute()
+    return migrated
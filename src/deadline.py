@@ -0,0 +1,69 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Dict, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Absolute time.monotonic() deadline for the current task; copied into tasks it spawns.
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    # Nested deadlines can only tighten the outer one.
+    if seconds is None:
+        yield
+        return
+    target = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(target if outer is None else min(outer, target))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+async def within_deadline(aw: Awaitable[T]) -> T:
+    """Awaits ``aw``, cancelling it and raising DeadlineExceeded once the current deadline passes."""
+    left = remaining()
+    if left is None:
+        return await aw
+    if left <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(aw, left)
+    except asyncio.TimeoutError as e:
+        if isinstance(e, DeadlineExceeded):
+            raise
+        raise DeadlineExceeded() from e
+
+
+class StageEstimator:
+    """Exponentially weighted mean duration per stage, used to decide whether work still fits."""
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self._means: Dict[str, float] = {}
+
+    def observe(self, stage: str, seconds: float):
+        mean = self._means.get(stage)
+        self._means[stage] = seconds if mean is None else mean + self.alpha * (seconds - mean)
+
+    def expected(self, stage: str) -> Optional[float]:
+        return self._means.get(stage)
+
+
+stage_estimator = StageEstimator()
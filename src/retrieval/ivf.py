@@ -0,0 +1,156 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.retrieval.scoring import EmbeddingMatrix, normalize_rows, top_k_indices
+
+ANN_MIN_POOL_SIZE = int(os.getenv("ANN_MIN_POOL_SIZE", 20000))
+ANN_N_PROBE = int(os.getenv("ANN_N_PROBE", 16))
+
+
+class IvfFlatIndex:
+    """IVF-flat index over the rows of an EmbeddingMatrix.
+
+    Only the coarse centroids and each row's list assignment are held here; vectors stay
+    in the matrix, so the index adds no copy of the embeddings. Assignments are persisted
+    per story id, which lets a reload reuse them and only assign stories added since.
+    """
+
+    def __init__(self, centroids: np.ndarray, n_probe: int = ANN_N_PROBE, trained_size: int = 0):
+        self.centroids = normalize_rows(centroids)
+        self.n_probe = n_probe
+        self.trained_size = trained_size
+        self.matrix: Optional[EmbeddingMatrix] = None
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.lists: List[np.ndarray] = []
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(
+        cls,
+        matrix: EmbeddingMatrix,
+        n_lists: Optional[int] = None,
+        n_probe: int = ANN_N_PROBE,
+        iterations: int = 10,
+        sample_size: int = 100000,
+        seed: int = 0
+    ) -> "IvfFlatIndex":
+        # Spherical k-means on a sample; rows are already unit length.
+        n = len(matrix)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = matrix.vectors[rng.choice(n, size=min(n, sample_size), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = ~np.any(sums, axis=1)
+            # Re-seed empty lists from random sample rows so no centroid goes dead.
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        index = cls(centroids, n_probe=n_probe, trained_size=n)
+        index.build(matrix)
+        return index
+
+    def assign(self, vectors: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch_size):
+            chunk = vectors[start:start + batch_size]
+            out[start:start + batch_size] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return out
+
+    def build(self, matrix: EmbeddingMatrix, known: Optional[Dict[int, int]] = None):
+        # Reuse list assignments for ids seen before; only new rows are assigned.
+        known = known or {}
+        assignments = np.full(len(matrix), -1, dtype=np.int32)
+        for row, story_id in enumerate(matrix.ids.tolist()):
+            assignments[row] = known.get(story_id, -1)
+        new_rows = np.flatnonzero(assignments < 0)
+        if len(new_rows):
+            assignments[new_rows] = self.assign(matrix.vectors[new_rows])
+        self.matrix = matrix
+        self.assignments = assignments
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+
+    def updated(self, matrix: EmbeddingMatrix, changed_ids: Sequence[int] = ()) -> "IvfFlatIndex":
+        # Same centroids over a patched matrix: untouched rows keep their lists, changed and
+        # new rows are assigned.
+        known = dict(zip(self.matrix.ids.tolist(), self.assignments.tolist())) if self.matrix is not None else {}
+        for story_id in changed_ids:
+            known.pop(int(story_id), None)
+        index = IvfFlatIndex(self.centroids, self.n_probe, self.trained_size)
+        index.build(matrix, known)
+        return index
+
+    def needs_retrain(self) -> bool:
+        return self.matrix is not None and len(self.matrix) > 4 * max(self.trained_size, 1)
+
+    def search(self, query: Sequence[float], k: int) -> List[Tuple[int, float]]:
+        if self.matrix is None or len(self.matrix) == 0:
+            return []
+        q = normalize_rows(np.asarray(query, dtype=np.float32))
+        probes = top_k_indices(self.centroids @ q, min(self.n_probe, self.n_lists))
+        rows = np.concatenate([self.lists[p] for p in probes])
+        if len(rows) < k:
+            # Too few candidates in the probed lists; an exact scan is cheap at this size anyway.
+            return self.matrix.top_k(q, k)
+        scores = self.matrix.vectors[rows] @ q
+        idx = top_k_indices(scores, k)
+        return [(int(self.matrix.ids[rows[i]]), float(scores[i])) for i in idx]
+
+    def save(self, path: str, version: Optional[str] = None):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(path, "ids.npy"), self.matrix.ids if self.matrix is not None else np.empty(0, np.int64))
+        np.save(os.path.join(path, "assignments.npy"), self.assignments)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"n_probe": self.n_probe, "trained_size": self.trained_size, "version": version}, f)
+
+    @classmethod
+    def load(cls, path: str) -> Tuple["IvfFlatIndex", Dict[int, int], Optional[str]]:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        index = cls(np.load(os.path.join(path, "centroids.npy")), meta["n_probe"], meta["trained_size"])
+        ids = np.load(os.path.join(path, "ids.npy"))
+        assignments = np.load(os.path.join(path, "assignments.npy"))
+        return index, dict(zip(ids.tolist(), assignments.tolist())), meta.get("version")
+
+
+def load_or_build_index(matrix: EmbeddingMatrix, path: Optional[str], version: Optional[str]) -> IvfFlatIndex:
+    index = None
+    if path and os.path.exists(os.path.join(path, "meta.json")):
+        index, known, saved_version = IvfFlatIndex.load(path)
+        index.build(matrix, known)
+        if index.needs_retrain():
+            index = None
+        elif saved_version == version:
+            return index
+    if index is None:
+        index = IvfFlatIndex.train(matrix)
+    if path:
+        index.save(path, version)
+    return index
+
+
+def recall_at_k(
+    index: IvfFlatIndex,
+    queries: Sequence[Sequence[float]],
+    k: int = 60
+) -> float:
+    # Mean overlap between the ANN top-k and the exact top-k from the same matrix.
+    exact = index.matrix.top_k_batch(queries, k)
+    hits = 0
+    total = 0
+    for query, truth in zip(queries, exact):
+        approx = {story_id for story_id, _ in index.search(query, k)}
+        hits += len(approx & {story_id for story_id, _ in truth})
+        total += len(truth)
+    return hits / total if total else 1.0
@@ -0,0 +1,185 @@
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.retrieval.ivf import recall_at_k
+from src.retrieval.scoring import EmbeddingMatrix, normalize_rows, top_k_indices
+
+# "" (off), "int8", "pca" or "pca+int8".
+PREFILTER_COMPRESSION = os.getenv("PREFILTER_COMPRESSION", "")
+COMPRESSION_MODES = ("int8", "pca", "pca+int8")
+PCA_DIM = int(os.getenv("PCA_DIM", 256))
+# Candidates re-ranked on full vectors, as a multiple of k.
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", 4))
+
+_BLOCK = 65536
+# Small enough that each widened block stays in cache.
+_SCAN_BLOCK = 512
+
+
+class PcaProjection:
+    """Top principal directions of the pool. For a unit query q and story x,
+    q·x = q·mean + (Pq)·(P(x - mean)) + residual; the first term is the same for every
+    story, so ranking by the projected product loses only the residual."""
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray):
+        self.mean = mean.astype(np.float32)
+        self.components = components.astype(np.float32)
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, dim: int, sample_size: int = 20000, seed: int = 0) -> "PcaProjection":
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(vectors), size=min(len(vectors), sample_size), replace=False))
+        sample = np.asarray(vectors[rows], dtype=np.float32)
+        mean = sample.mean(axis=0)
+        centered = sample - mean
+        # Eigenvectors of the dim x dim covariance: much cheaper than an SVD of the sample.
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        return cls(mean, eigenvectors[:, ::-1][:, :dim].T)
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        return (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+
+    def project_query(self, query: np.ndarray) -> np.ndarray:
+        return self.components @ query
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Symmetric per-vector scale: each row's largest magnitude maps to 127.
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class CompressedIndex:
+    """Coarse scan over int8 and/or PCA-reduced copies of the matrix rows, then an exact
+    re-rank of the best ``rerank_factor * k`` on the full vectors.
+
+    Exposes ``matrix`` and ``search`` like IvfFlatIndex, so it plugs into the same places.
+    The full vectors are only touched for re-ranking, so they can stay memory-mapped.
+    """
+
+    def __init__(
+        self,
+        matrix: EmbeddingMatrix,
+        mode: str = "int8",
+        pca_dim: int = PCA_DIM,
+        rerank_factor: int = RERANK_FACTOR,
+        projection: Optional[PcaProjection] = None
+    ):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError(f"unknown compression mode {mode!r}; expected one of {COMPRESSION_MODES}")
+        self.matrix = matrix
+        self.mode = mode
+        self.rerank_factor = rerank_factor
+        self.projection = None
+        if "pca" in mode:
+            self.projection = projection or PcaProjection.fit(matrix.vectors, min(pca_dim, matrix.dim))
+        self.data, self.scales = self.encode(matrix.vectors)
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        dim = self.projection.dim if self.projection is not None else vectors.shape[1]
+        quantize = "int8" in self.mode
+        data = np.empty((len(vectors), dim), dtype=np.int8 if quantize else np.float32)
+        scales = np.empty(len(vectors), dtype=np.float32) if quantize else None
+        for start in range(0, len(vectors), _BLOCK):
+            block = np.asarray(vectors[start:start + _BLOCK], dtype=np.float32)
+            if self.projection is not None:
+                block = self.projection.project(block)
+            if quantize:
+                data[start:start + _BLOCK], scales[start:start + _BLOCK] = quantize_int8(block)
+            else:
+                data[start:start + _BLOCK] = block
+        return data, scales
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def coarse_scores(self, query: np.ndarray) -> np.ndarray:
+        q = self.projection.project_query(query) if self.projection is not None else query
+        if self.scales is None:
+            return self.data @ q
+        # Widened one block at a time, so only the int8 codes stream from memory.
+        scores = np.empty(len(self.data), dtype=np.float32)
+        for start in range(0, len(self.data), _SCAN_BLOCK):
+            scores[start:start + _SCAN_BLOCK] = self.data[start:start + _SCAN_BLOCK].astype(np.float32) @ q
+        return scores * self.scales
+
+    def search(self, query: Sequence[float], k: int) -> List[Tuple[int, float]]:
+        if len(self.matrix) == 0:
+            return []
+        q = normalize_rows(np.asarray(query, dtype=np.float32))
+        candidates = np.sort(top_k_indices(self.coarse_scores(q), min(len(self.matrix), k * self.rerank_factor)))
+        exact = self.matrix.vectors[candidates] @ q
+        idx = top_k_indices(exact, k)
+        return [(int(self.matrix.ids[candidates[i]]), float(exact[i])) for i in idx]
+
+    def updated(self, matrix: EmbeddingMatrix, changed_ids: Sequence[int] = ()) -> "CompressedIndex":
+        # Keeps the fitted projection; only changed and new rows are encoded.
+        index = CompressedIndex.__new__(CompressedIndex)
+        index.matrix, index.mode, index.rerank_factor, index.projection = (
+            matrix, self.mode, self.rerank_factor, self.projection
+        )
+        changed = {int(i) for i in changed_ids}
+        old_rows = np.array([
+            -1 if story_id in changed else self.matrix.row_of.get(story_id, -1)
+            for story_id in matrix.ids.tolist()
+        ], dtype=np.int64)
+        index.data = np.empty((len(matrix), self.data.shape[1]), dtype=self.data.dtype)
+        index.scales = np.empty(len(matrix), dtype=np.float32) if self.scales is not None else None
+        kept = old_rows >= 0
+        index.data[kept] = self.data[old_rows[kept]]
+        fresh = np.flatnonzero(~kept)
+        if len(fresh):
+            data, scales = index.encode(matrix.vectors[fresh])
+            index.data[fresh] = data
+        if index.scales is not None:
+            index.scales[kept] = self.scales[old_rows[kept]]
+            if len(fresh):
+                index.scales[fresh] = scales
+        return index
+
+
+def compression_report(
+    matrix: EmbeddingMatrix,
+    queries: Sequence[Sequence[float]],
+    k: int = 60,
+    modes: Sequence[str] = COMPRESSION_MODES,
+    pca_dim: int = PCA_DIM,
+    rerank_factor: int = RERANK_FACTOR
+) -> List[Dict[str, float]]:
+    """Recall@k against the exact scan, bytes held and median query latency per mode."""
+
+    def median_ms(search) -> float:
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            search(query, k)
+            timings.append(time.perf_counter() - started)
+        return float(np.median(timings) * 1000) if timings else 0.0
+
+    rows = [{
+        "mode": "exact", "bytes": matrix.vectors.nbytes, "memory_ratio": 1.0,
+        "recall": 1.0, "p50_ms": median_ms(matrix.top_k), "build_s": 0.0,
+    }]
+    for mode in modes:
+        started = time.perf_counter()
+        index = CompressedIndex(matrix, mode, pca_dim=pca_dim, rerank_factor=rerank_factor)
+        build_s = time.perf_counter() - started
+        rows.append({
+            "mode": mode,
+            "bytes": index.nbytes,
+            "memory_ratio": index.nbytes / max(matrix.vectors.nbytes, 1),
+            "recall": recall_at_k(index, queries, k),
+            "p50_ms": median_ms(index.search),
+            "build_s": build_s,
+        })
+    return rows
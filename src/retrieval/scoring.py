@@ -0,0 +1,138 @@
+from typing import List, Optional, Sequence, Tuple, Dict
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray, inplace: bool = False) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    if inplace:
+        return np.divide(matrix, norms, out=matrix)
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # argpartition is O(n); only the k survivors get fully sorted.
+    n = scores.shape[-1]
+    if k <= 0 or n == 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, axis=-1)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    part_scores = np.take_along_axis(scores, part, axis=-1)
+    order = np.argsort(-part_scores, axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class DimensionMismatch(ValueError):
+    # Raised when a delta's embeddings do not match the matrix, e.g. after a model change.
+    pass
+
+
+class EmbeddingMatrix:
+    """Row-normalized float32 story matrix, so cosine similarity is a single matmul."""
+
+    def __init__(
+        self,
+        ids: Sequence[int],
+        vectors: np.ndarray,
+        normalized: bool = False,
+        copy: bool = True
+    ):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids):
+            raise ValueError(f"expected ({len(ids)}, dim) matrix, got {vectors.shape}")
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.vectors = vectors if normalized else normalize_rows(vectors, inplace=not copy)
+        self._row_of: Optional[Dict[int, int]] = None
+
+    @property
+    def row_of(self) -> Dict[int, int]:
+        # Built on first use: a memory-mapped matrix can then be opened without touching every id.
+        if self._row_of is None:
+            self._row_of = {story_id: row for row, story_id in enumerate(self.ids.tolist())}
+        return self._row_of
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def subset(self, ids: Sequence[int]) -> "EmbeddingMatrix":
+        rows = [self.row_of[int(i)] for i in ids if int(i) in self.row_of]
+        return EmbeddingMatrix(self.ids[rows], self.vectors[rows], normalized=True)
+
+    def updated(
+        self,
+        ids: Sequence[int],
+        vectors: np.ndarray,
+        removed: Sequence[int] = ()
+    ) -> "EmbeddingMatrix":
+        # Copy-on-write delta: rows for ``ids`` are replaced or appended and ``removed`` rows
+        # dropped, so readers holding this matrix never see a half-applied change.
+        if not len(ids):
+            # A retire-only delta arrives as an empty (0, 0) read.
+            vectors = np.empty((0, self.dim if len(self) else 0), dtype=np.float32)
+        vectors = normalize_rows(vectors)
+        if len(ids) and len(self) and vectors.shape[1] != self.dim:
+            raise DimensionMismatch(f"delta has dim {vectors.shape[1]}, matrix has {self.dim}")
+        replaced_rows, replaced_from, appended = [], [], []
+        for i, story_id in enumerate(int(s) for s in ids):
+            row = self.row_of.get(story_id)
+            if row is None:
+                appended.append(i)
+            else:
+                replaced_rows.append(row)
+                replaced_from.append(i)
+        all_ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)[appended]])
+        base = self.vectors if len(self) else np.empty((0, vectors.shape[1]), dtype=np.float32)
+        all_vectors = np.concatenate([base, vectors[appended]])
+        all_vectors[replaced_rows] = vectors[replaced_from]
+        drop = [self.row_of[int(i)] for i in removed if int(i) in self.row_of]
+        if drop:
+            keep = np.ones(len(all_ids), dtype=bool)
+            keep[drop] = False
+            all_ids, all_vectors = all_ids[keep], all_vectors[keep]
+        return EmbeddingMatrix(all_ids, all_vectors, normalized=True, copy=False)
+
+    def scores(self, query: Sequence[float]) -> np.ndarray:
+        q = normalize_rows(np.asarray(query, dtype=np.float32))
+        return self.vectors @ q
+
+    def top_k(self, query: Sequence[float], k: int) -> List[Tuple[int, float]]:
+        if len(self) == 0:
+            return []
+        scores = self.scores(query)
+        idx = top_k_indices(scores, k)
+        return [(int(self.ids[i]), float(scores[i])) for i in idx]
+
+    def top_k_batch(self, queries: Sequence[Sequence[float]], k: int) -> List[List[Tuple[int, float]]]:
+        if len(self) == 0:
+            return [[] for _ in queries]
+        q = normalize_rows(np.asarray(queries, dtype=np.float32))
+        scores = q @ self.vectors.T
+        idx = top_k_indices(scores, k)
+        return [
+            [(int(self.ids[i]), float(row_scores[i])) for i in row_idx]
+            for row_idx, row_scores in zip(idx, scores)
+        ]
+
+
+def rank_stories(
+    matrix: EmbeddingMatrix,
+    query: Sequence[float],
+    story_pool: Sequence[dict],
+    top_k: int,
+    index=None
+) -> List[dict]:
+    # ``index`` is an optional ANN index over ``matrix``; it is only used when the
+    # caller's pool is exactly the indexed one, otherwise the exact scan runs.
+    by_id = {int(s['id']): s for s in story_pool}
+    if len(by_id) != len(matrix) or any(i not in matrix.row_of for i in by_id):
+        matrix = matrix.subset(list(by_id))
+    elif index is not None and index.matrix is matrix:
+        return [by_id[story_id] for story_id, _ in index.search(query, top_k)]
+    return [by_id[story_id] for story_id, _ in matrix.top_k(query, top_k)]
@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.retrieval.scoring import EmbeddingMatrix, normalize_rows, top_k_indices
+
+# Worker processes for exact scoring; 0 keeps scoring in the calling process.
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", 0))
+# Below this many stories, process hops cost more than the scan they parallelize.
+SHARDED_MIN_POOL_SIZE = int(os.getenv("SHARDED_MIN_POOL_SIZE", 200000))
+
+# (kind, name, offset, rows, dim): kind "shm" names a SharedMemory segment, "file" a
+# memory-mapped .npy whose data starts ``offset`` bytes in.
+SegmentSpec = Tuple[str, str, int, int, int]
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_workers = 0
+
+# Per worker process: the segment attached most recently, reused until a new pool arrives.
+_attached: Dict[SegmentSpec, Tuple[Optional[shared_memory.SharedMemory], np.ndarray]] = {}
+
+
+def _attach(spec: SegmentSpec) -> np.ndarray:
+    entry = _attached.get(spec)
+    if entry is not None:
+        return entry[1]
+    for shm, _ in _attached.values():
+        if shm is not None:
+            shm.close()
+    _attached.clear()
+    kind, name, offset, rows, dim = spec
+    if kind == "file":
+        shm = None
+        vectors = np.memmap(name, dtype=np.float32, mode="r", offset=offset, shape=(rows, dim))
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        vectors = np.ndarray((rows, dim), dtype=np.float32, buffer=shm.buf)
+    _attached[spec] = (shm, vectors)
+    return vectors
+
+
+def _score_shard(
+    spec: SegmentSpec,
+    start: int,
+    end: int,
+    queries: np.ndarray,
+    k: int
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # Runs in a worker: local top-k rows (absolute) and scores per query, best first.
+    scores = _attach(spec)[start:end] @ queries.T
+    results = []
+    for column in scores.T:
+        idx = top_k_indices(column, k)
+        results.append((idx + start, column[idx]))
+    return results
+
+
+def get_executor(workers: int = SCORING_WORKERS) -> ProcessPoolExecutor:
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        # Spawned, not forked: the parent holds event-loop and Redis connection state.
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        _executor_workers = workers
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def _mapped_file(vectors: np.ndarray) -> Optional[Tuple[str, int]]:
+    # (path, data offset) when ``vectors`` views the start of a memory-mapped file. np.asarray
+    # drops the memmap subclass, so the mapping is found by walking the view's bases.
+    root = None
+    base = vectors
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            root = base
+        base = base.base
+    if root is None or not root.filename or not vectors.flags.c_contiguous:
+        return None
+    if root.ctypes.data != vectors.ctypes.data:
+        return None
+    return root.filename, int(root.offset)
+
+
+class ShardedScorer:
+    """Exact top-k over ``matrix`` split row-wise across worker processes.
+
+    The vectors are shared, not pickled: a matrix mapped from the embedding store is opened
+    by path in each worker, anything else is copied once into a SharedMemory segment. Each
+    shard returns its own top-k and the parent merges the sorted lists, so only
+    ``shards * k`` scores cross the process boundary per query.
+    """
+
+    def __init__(self, matrix: EmbeddingMatrix, workers: int = SCORING_WORKERS, shards: Optional[int] = None):
+        self.matrix = matrix
+        self.workers = max(1, workers)
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self.spec = self._share(matrix.vectors)
+        n = len(matrix)
+        bounds = np.linspace(0, n, min(n, shards or self.workers) + 1, dtype=np.int64)
+        self.shards = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def _share(self, vectors: np.ndarray) -> SegmentSpec:
+        rows, dim = vectors.shape
+        mapped = _mapped_file(vectors)
+        if mapped is not None:
+            # e.g. the embedding store's vectors.npy; workers map the same pages.
+            return "file", mapped[0], mapped[1], rows, dim
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, vectors.nbytes))
+        np.ndarray((rows, dim), dtype=np.float32, buffer=self._shm.buf)[:] = vectors
+        return "shm", self._shm.name, 0, rows, dim
+
+    async def search_batch(self, queries: Sequence[Sequence[float]], k: int) -> List[List[Tuple[int, float]]]:
+        if len(self.matrix) == 0:
+            return [[] for _ in queries]
+        q = normalize_rows(np.asarray(queries, dtype=np.float32))
+        loop = asyncio.get_running_loop()
+        executor = get_executor(self.workers)
+        shard_results = await asyncio.gather(*(
+            loop.run_in_executor(executor, _score_shard, self.spec, start, end, q, k)
+            for start, end in self.shards
+        ))
+        ids = self.matrix.ids
+        merged = []
+        for i in range(len(q)):
+            # k-way merge of the shards' descending lists.
+            best = heapq.merge(
+                *(zip(shard[i][1].tolist(), shard[i][0].tolist()) for shard in shard_results),
+                key=lambda item: -item[0]
+            )
+            merged.append([(int(ids[row]), score) for score, row in (next(best) for _ in range(min(k, len(ids))))])
+        return merged
+
+    async def search(self, query: Sequence[float], k: int) -> List[Tuple[int, float]]:
+        return (await self.search_batch([query], k))[0]
+
+    async def warm(self):
+        # Spawns the workers and attaches the segment before the first real query.
+        if len(self.matrix):
+            await self.search(self.matrix.vectors[0], 1)
+
+    def close(self):
+        # Unlinks the segment; workers still attached keep their mapping until they move on.
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
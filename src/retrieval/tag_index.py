@@ -0,0 +1,116 @@
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.dataclass import Story
+from src.retrieval.scoring import top_k_indices
+
+# "dense" (embeddings only), "tags" (inverted index only) or "hybrid" (both, fused with RRF).
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+RETRIEVAL_MODES = ("dense", "tags", "hybrid")
+RRF_K = int(os.getenv("RRF_K", 60))
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_tag(tag: str) -> str:
+    # "Enemies-to-Lovers", "enemies_to_lovers" and " enemies to  lovers" are the same tag.
+    return _NON_WORD.sub(" ", str(tag).lower()).strip()
+
+
+def normalize_tags(tags: Iterable[str]) -> List[str]:
+    return list(dict.fromkeys(t for t in (normalize_tag(tag) for tag in tags) if t))
+
+
+class TagIndex:
+    """Inverted index from normalized tag to stories, scored with BM25.
+
+    Each posting list stores row numbers and the tag's precomputed BM25 weight for that
+    row (tags occur at most once per story, so term frequency is always 1). A query adds
+    the postings of its tags into one score array; no embedding call is needed.
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[int],
+        story_tags: Sequence[Sequence[str]],
+        k1: float = 1.2,
+        b: float = 0.75
+    ):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.story_tags = [list(tags) for tags in story_tags]
+        self.k1, self.b = k1, b
+        self.row_of: Dict[int, int] = {int(story_id): row for row, story_id in enumerate(self.ids)}
+        rows_by_tag: Dict[str, List[int]] = {}
+        lengths = np.zeros(len(self.ids), dtype=np.float32)
+        for row, tags in enumerate(story_tags):
+            normalized = normalize_tags(tags)
+            lengths[row] = len(normalized)
+            for tag in normalized:
+                rows_by_tag.setdefault(tag, []).append(row)
+
+        n = len(self.ids)
+        avg_length = float(lengths.mean()) if n else 0.0
+        norm = k1 * (1 - b + b * lengths / (avg_length or 1.0))
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for tag, rows in rows_by_tag.items():
+            rows_arr = np.asarray(rows, dtype=np.int64)
+            idf = np.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            weights = (idf * (k1 + 1) / (1 + norm[rows_arr])).astype(np.float32)
+            self.postings[tag] = (rows_arr, weights)
+
+    @classmethod
+    def from_stories(cls, stories: Sequence[Story], **kwargs) -> "TagIndex":
+        return cls([s['id'] for s in stories], [s['tags'] for s in stories], **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def updated(self, stories: Sequence[Story], removed: Sequence[int] = ()) -> "TagIndex":
+        # IDF and average length shift with any change, so weights are recomputed, but from
+        # the tags held here rather than by re-reading the pool.
+        tags_by_id = dict(zip(self.ids.tolist(), self.story_tags))
+        for story_id in removed:
+            tags_by_id.pop(int(story_id), None)
+        for story in stories:
+            tags_by_id[int(story['id'])] = story['tags']
+        return TagIndex(list(tags_by_id), list(tags_by_id.values()), k1=self.k1, b=self.b)
+
+    def scores(self, tags: Iterable[str]) -> np.ndarray:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for tag in normalize_tags(tags):
+            posting = self.postings.get(tag)
+            if posting is not None:
+                # Rows are unique within a posting list, so fancy-index += is safe here.
+                scores[posting[0]] += posting[1]
+        return scores
+
+    def search(
+        self,
+        tags: Iterable[str],
+        k: int,
+        allowed: Optional[np.ndarray] = None
+    ) -> List[Tuple[int, float]]:
+        # ``allowed`` is an optional boolean row mask restricting the candidates.
+        scores = self.scores(tags)
+        if allowed is not None:
+            scores[~allowed] = 0
+        matched = int(np.count_nonzero(scores))
+        rows = top_k_indices(scores, min(k, matched))
+        return [(int(self.ids[r]), float(scores[r])) for r in rows]
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[int]],
+    top_k: Optional[int] = None,
+    k: int = RRF_K
+) -> List[Tuple[int, float]]:
+    # Each list contributes 1 / (k + rank); ties keep first-seen order.
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, story_id in enumerate(ranking, start=1):
+            fused[story_id] = fused.get(story_id, 0.0) + 1.0 / (k + rank)
+    ranked = sorted(fused.items(), key=lambda item: -item[1])
+    return ranked[:top_k] if top_k is not None else ranked
@@ -0,0 +1,188 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, IO, Iterator, Optional, Tuple
+
+# Upper bounds in seconds for the stage latency histograms.
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Telemetry:
+    """In-process counters and stage timings, exportable as Prometheus text or JSON lines.
+
+    When disabled every call returns immediately (``span`` hands back a shared no-op
+    context manager), so instrumentation can stay in the hot path.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.counters: Dict[LabelKey, float] = {}
+        self.histograms: Dict[LabelKey, list] = {}
+        self._sink: Optional[IO[str]] = None
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: Optional[bool] = None, jsonl_path: Optional[str] = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if jsonl_path:
+            self._sink = open(jsonl_path, "a", buffering=1, encoding="utf-8")
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def incr(self, name: str, value: float = 1, **labels: Any):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float, **labels: Any):
+        if not self.enabled:
+            return
+        key = _key(stage, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # bucket counts..., +Inf count, sum
+                hist = self.histograms[key] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[len(DURATION_BUCKETS)] += 1
+            hist[-1] += seconds
+        if self._sink is not None:
+            self._sink.write(json.dumps({"ts": time.time(), "span": stage, "ms": seconds * 1000, **labels}) + "\n")
+
+    def span(self, stage: str, **labels: Any):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return self._span(stage, labels)
+
+    @contextmanager
+    def _span(self, stage: str, labels: Dict[str, Any]) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+
+    def timed(self, stage: str):
+        # Decorator form of ``span`` for coroutine functions.
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await fn(*args, **kwargs)
+                with self._span(stage, {}):
+                    return await fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_usage(self, kind: str, model: str, usage: Any, estimated: bool = False):
+        # Estimates (e.g. streams closed before the API reported usage) go to their own
+        # counters, so the reported token totals stay exact.
+        if not self.enabled or usage is None:
+            return
+        prefix = "llm_estimated" if estimated else "llm"
+        self.incr(f"{prefix}_prompt_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, kind=kind, model=model)
+        self.incr(f"{prefix}_completion_tokens_total", getattr(usage, "completion_tokens", 0) or 0, kind=kind, model=model)
+
+    def record_redis(self, op: str, nbytes: int = 0, round_trips: int = 1):
+        if not self.enabled:
+            return
+        self.incr("redis_round_trips_total", round_trips, op=op)
+        if nbytes:
+            self.incr("redis_bytes_total", nbytes, op=op)
+
+    def record_cache(self, cache: str, hit: bool):
+        self.incr("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    def cache_hit_rates(self) -> Dict[str, float]:
+        totals: Dict[str, list] = {}
+        for (name, labels), value in self.counters.items():
+            if name != "cache_requests_total":
+                continue
+            label_map = dict(labels)
+            entry = totals.setdefault(label_map["cache"], [0.0, 0.0])
+            entry[0 if label_map["result"] == "hit" else 1] += value
+        return {cache: hits / (hits + misses) for cache, (hits, misses) in totals.items() if hits + misses}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, **dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "stages": [
+                    {"stage": stage, **dict(labels), "count": hist[len(DURATION_BUCKETS)],
+                     "sum_seconds": hist[-1]}
+                    for (stage, labels), hist in self.histograms.items()
+                ],
+                "cache_hit_rates": self.cache_hit_rates(),
+            }
+
+    def export_jsonl(self, path: str):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time(), **self.snapshot()}) + "\n")
+
+    def export_prometheus(self, prefix: str = "sekai") -> str:
+        def fmt(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+            items = list(labels) + ([extra] if extra else [])
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                seen.add(name)
+            lines.append(f"{prefix}_{name}{fmt(labels)} {value}")
+        if histograms:
+            lines.append(f"# TYPE {prefix}_stage_duration_seconds histogram")
+        for (stage, labels), hist in histograms:
+            labels = (("stage", stage),) + labels
+            for bound, count in zip(DURATION_BUCKETS, hist):
+                lines.append(f"{prefix}_stage_duration_seconds_bucket{fmt(labels, ('le', str(bound)))} {count}")
+            lines.append(f"{prefix}_stage_duration_seconds_bucket{fmt(labels, ('le', '+Inf'))} {hist[len(DURATION_BUCKETS)]}")
+            lines.append(f"{prefix}_stage_duration_seconds_sum{fmt(labels)} {hist[-1]}")
+            lines.append(f"{prefix}_stage_duration_seconds_count{fmt(labels)} {hist[len(DURATION_BUCKETS)]}")
+        rates = sorted(self.cache_hit_rates().items())
+        if rates:
+            lines.append(f"# TYPE {prefix}_cache_hit_ratio gauge")
+        for cache, rate in rates:
+            lines.append(f'{prefix}_cache_hit_ratio{{cache="{cache}"}} {rate}')
+        return "\n".join(lines) + "\n"
+
+
+telemetry = Telemetry(enabled=os.getenv("TELEMETRY_ENABLED", "1") not in ("0", "false", "False"))
+if os.getenv("TELEMETRY_JSONL"):
+    telemetry.configure(jsonl_path=os.getenv("TELEMETRY_JSONL"))
@@ -0,0 +1,186 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from benchmarks.fakes import FakeAsyncOpenAI
+from src.ai_agents import open_ai
+from src.ai_agents.id_stream import StoryIdStreamParser, stream_story_ids
+from src.ai_agents.open_ai import OPENAI_MAX_IN_FLIGHT, OpenAiAgent
+from src.telemetry import telemetry
+
+
+def feed_all(parser: StoryIdStreamParser, chunks):
+    accepted = []
+    for chunk in chunks:
+        accepted.extend(parser.feed(chunk))
+    accepted.extend(parser.finish())
+    return accepted
+
+
+def test_digits_split_across_chunks():
+    parser = StoryIdStreamParser()
+    assert feed_all(parser, ["[12", "3, 4", "56", "]"]) == [123, 456]
+
+
+def test_drops_non_candidates_and_repeats():
+    parser = StoryIdStreamParser(valid_ids=[1, 2, 3])
+    assert feed_all(parser, ["[1, 9, 2, 1, 3, 2]"]) == [1, 2, 3]
+
+
+def test_ignores_numbers_outside_array():
+    parser = StoryIdStreamParser()
+    assert feed_all(parser, ["Top 10 ids: [7, ", "8] and 99 more"]) == [7, 8]
+
+
+def test_stops_at_limit():
+    parser = StoryIdStreamParser(limit=2)
+    parser.feed("[5, 6, 7")
+    assert parser.done
+    assert parser.ids == [5, 6]
+
+
+def test_unterminated_number_flushed_on_finish():
+    parser = StoryIdStreamParser()
+    parser.feed("[4, 5")
+    assert parser.finish() == [5]
+    assert parser.ids == [4, 5]
+
+
+class CountingCompletions:
+    # Tracks how many streams are open at once.
+    def __init__(self, inner):
+        self.inner = inner
+        self.open = 0
+        self.peak = 0
+
+    async def create(self, **kwargs):
+        stream = await self.inner.create(**kwargs)
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+        close = stream.close
+
+        async def counted_close():
+            self.open -= 1
+            await close()
+
+        stream.close = counted_close
+        return stream
+
+
+def test_streams_hold_their_in_flight_slot():
+    fake = FakeAsyncOpenAI(dim=8, ms_per_output_token=1.0)
+    completions = CountingCompletions(fake.chat.completions)
+    fake.chat.completions = completions
+    OpenAiAgent.use_client(fake)
+    OpenAiAgent.set_max_concurrency(2)
+    messages = [{"role": "user", "content": "Stories:\n" + "\n".join(f"ID: {i}" for i in range(1, 30))}]
+
+    async def run():
+        return await asyncio.gather(*(
+            stream_story_ids(OpenAiAgent(), range(1, 30), model="gpt-4o", messages=messages)
+            for _ in range(10)
+        ))
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        OpenAiAgent.set_max_concurrency(OPENAI_MAX_IN_FLIGHT)
+        OpenAiAgent.use_client(None)
+    assert all(ids == list(range(1, 11)) for ids in results)
+    assert completions.peak == 2
+    assert completions.open == 0
+
+
+class FlakyCompletions:
+    # The first stream drops its connection after one chunk.
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        stream = await self.inner.create(**kwargs)
+        self.calls += 1
+        if self.calls > 1:
+            return stream
+        chunks = stream.__aiter__()
+
+        async def broken():
+            yield await chunks.__anext__()
+            raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+
+        stream.__aiter__ = broken
+        return stream
+
+
+def test_mid_stream_errors_are_retried():
+    fake = FakeAsyncOpenAI(dim=8)
+    completions = FlakyCompletions(fake.chat.completions)
+    fake.chat.completions = completions
+    OpenAiAgent.use_client(fake)
+    messages = [{"role": "user", "content": "Stories:\n" + "\n".join(f"ID: {i}" for i in range(1, 30))}]
+    try:
+        ids = asyncio.run(stream_story_ids(OpenAiAgent(), range(1, 30), model="gpt-4o", messages=messages))
+    finally:
+        OpenAiAgent.use_client(None)
+    assert completions.calls == 2
+    assert ids == list(range(1, 11))
+
+
+class RateLimitedCompletions:
+    # Every call is answered with a 429.
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        raise openai.RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+
+
+def test_streams_are_retried_once_per_attempt(monkeypatch):
+    monkeypatch.setattr(open_ai, "backoff_delay", lambda attempt, retry_after=None: 0.0)
+    fake = FakeAsyncOpenAI(dim=8)
+    completions = RateLimitedCompletions()
+    fake.chat.completions = completions
+    OpenAiAgent.use_client(fake)
+    messages = [{"role": "user", "content": "Stories:\n" + "\n".join(f"ID: {i}" for i in range(1, 30))}]
+    try:
+        with pytest.raises(openai.RateLimitError):
+            asyncio.run(stream_story_ids(OpenAiAgent(), range(1, 30), model="gpt-4o", messages=messages))
+    finally:
+        OpenAiAgent.set_max_concurrency(OPENAI_MAX_IN_FLIGHT)
+        OpenAiAgent.use_client(None)
+    assert completions.calls == open_ai.OPENAI_MAX_RETRIES + 1
+
+
+def token_counters(name):
+    return sum(v for (metric, _), v in telemetry.counters.items() if metric == name)
+
+
+def test_stream_usage_is_reported_or_marked_estimated():
+    OpenAiAgent.use_client(FakeAsyncOpenAI(dim=8))
+    messages = [{"role": "user", "content": "Stories:\n" + "\n".join(f"ID: {i}" for i in range(1, 30))}]
+
+    async def read(limit=None):
+        # Stops after ``limit`` deltas, like a caller that has all the IDs it needs.
+        async with OpenAiAgent().chat_stream(model="gpt-4o", messages=messages, max_tokens=200) as deltas:
+            received = 0
+            async for _ in deltas:
+                received += 1
+                if received == limit:
+                    break
+
+    telemetry.reset()
+    try:
+        asyncio.run(read())
+        assert token_counters("llm_prompt_tokens_total") > 0
+        assert token_counters("llm_estimated_prompt_tokens_total") == 0
+        telemetry.reset()
+        asyncio.run(read(limit=2))
+        assert token_counters("llm_prompt_tokens_total") == 0
+        assert token_counters("llm_estimated_completion_tokens_total") > 0
+    finally:
+        telemetry.reset()
+        OpenAiAgent.use_client(None)
@@ -0,0 +1,89 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from src.retrieval.scoring import DimensionMismatch, EmbeddingMatrix
+
+
+def unit(rows):
+    vectors = np.asarray(rows, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def base_matrix() -> EmbeddingMatrix:
+    return EmbeddingMatrix([1, 2, 3], np.eye(3, dtype=np.float32))
+
+
+def test_upsert_only_delta():
+    matrix = base_matrix().updated([2, 4], np.asarray([[1, 1, 0], [0, 1, 1]], dtype=np.float32))
+    assert matrix.ids.tolist() == [1, 2, 3, 4]
+    np.testing.assert_allclose(matrix.vectors[1:], unit([[1, 1, 0], [0, 0, 1], [0, 1, 1]]))
+
+
+def test_retire_only_delta():
+    # Reading no embeddings from Redis yields a (0, 0) array.
+    matrix = base_matrix().updated([], np.empty((0, 0), dtype=np.float32), removed=[2])
+    assert matrix.ids.tolist() == [1, 3]
+    np.testing.assert_allclose(matrix.vectors, unit([[1, 0, 0], [0, 0, 1]]))
+
+
+def test_mixed_delta():
+    matrix = base_matrix().updated([3, 5], np.asarray([[1, 0, 1], [1, 1, 1]], dtype=np.float32), removed=[1])
+    assert matrix.ids.tolist() == [2, 3, 5]
+    np.testing.assert_allclose(matrix.vectors, unit([[0, 1, 0], [1, 0, 1], [1, 1, 1]]))
+
+
+def test_dimension_change_is_reported():
+    with pytest.raises(DimensionMismatch):
+        base_matrix().updated([4], np.ones((1, 5), dtype=np.float32))
+
+
+def is_mapped(vectors: np.ndarray) -> bool:
+    while isinstance(vectors, np.ndarray):
+        if isinstance(vectors, np.memmap):
+            return True
+        vectors = vectors.base
+    return False
+
+
+@pytest.mark.parametrize("backend", ["redis", "mmap"])
+@pytest.mark.parametrize("upsert, retire", [(True, False), (False, True), (True, True)])
+def test_pool_cache_patches_instead_of_reloading(upsert, retire, backend, tmp_path, monkeypatch):
+    pytest.importorskip("fakeredis")
+    import src.cache.pool_matrix as pool_matrix
+    monkeypatch.setattr(pool_matrix, "EMBEDDING_BACKEND", backend)
+    monkeypatch.setattr(pool_matrix, "EMBEDDING_STORE_PATH", str(tmp_path))
+    from benchmarks.fakes import FakeAsyncOpenAI, fake_redis_clients, synthetic_stories
+    from src.ai_agents.open_ai import OpenAiAgent
+    from src.ai_agents.story_embeddings import embed_and_cache_stories
+    from src.ai_agents.story_pool import update_stories
+    from src.cache.pool_matrix import PoolMatrixCache
+    from src.cache.redis import cache_story_pool, get_story_embedding_matrix, get_story_ids, use_redis_clients
+    from src.telemetry import telemetry
+
+    async def run():
+        OpenAiAgent.use_client(FakeAsyncOpenAI(dim=16))
+        use_redis_clients(*fake_redis_clients())
+        pool = synthetic_stories(50)
+        await cache_story_pool(pool)
+        await embed_and_cache_stories(pool)
+        cache = PoolMatrixCache()
+        await cache.get()
+        upserts = synthetic_stories(2, seed=1, start_id=900000) if upsert else []
+        retired = [pool[0]['id']] if retire else []
+        await update_stories(upserts, retired)
+        patches = telemetry.counters.get(("pool_matrix_patches_total", ()), 0)
+        matrix = await cache.get()
+        assert telemetry.counters.get(("pool_matrix_patches_total", ()), 0) == patches + 1
+        ids, vectors = await get_story_embedding_matrix(await get_story_ids())
+        assert sorted(matrix.ids.tolist()) == sorted(ids)
+        order = [matrix.row_of[i] for i in ids]
+        np.testing.assert_allclose(matrix.vectors[order], EmbeddingMatrix(ids, vectors).vectors, atol=1e-6)
+        # The mmap backend maps a newly published snapshot instead of copying into memory.
+        assert is_mapped(matrix.vectors) == (backend == "mmap")
+
+    try:
+        asyncio.run(run())
+    finally:
+        OpenAiAgent.use_client(None)
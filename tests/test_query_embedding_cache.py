@@ -0,0 +1,36 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from src.cache.query_embedding_cache import QueryEmbeddingCache
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    pytest.importorskip("fakeredis")
+    from benchmarks.fakes import fake_redis_clients
+    from src.cache.redis import use_redis_clients
+
+    calls = []
+
+    async def embed(text):
+        calls.append(text)
+        await asyncio.sleep(0.05)
+        return [1.0, 0.0, 0.0]
+
+    async def run():
+        use_redis_clients(*fake_redis_clients())
+        cache = QueryEmbeddingCache()
+        leader = asyncio.ensure_future(cache.get(["romance"], "m", embed))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(cache.get(["romance"], "m", embed))
+        await asyncio.sleep(0)
+        leader.cancel()
+        embedding = await follower
+        assert leader.cancelled()
+        np.testing.assert_allclose(embedding, [1.0, 0.0, 0.0])
+        # The shared call finished and was cached for later callers.
+        np.testing.assert_allclose(await cache.get(["romance"], "m", embed), [1.0, 0.0, 0.0])
+        assert calls == ["romance"]
+
+    asyncio.run(run())
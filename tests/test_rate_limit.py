@@ -0,0 +1,27 @@
+from src.ai_agents.rate_limit import AdaptiveConcurrencyLimiter, latency_kind
+
+
+def chat(max_tokens, n=None, prompt="Tags: a, b"):
+    request = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+    if n is not None:
+        request["n"] = n
+    return request
+
+
+def test_kind_separates_choice_count_and_input_size():
+    assert latency_kind(chat(200)) != latency_kind(chat(200, n=4))
+    assert latency_kind(chat(200)) != latency_kind(chat(200, prompt="x" * 20000))
+    assert latency_kind(chat(200, prompt="x" * 1100)) == latency_kind(chat(200, prompt="y" * 1300))
+    small = {"model": "text-embedding-3-small", "input": ["a"] * 4}
+    large = {"model": "text-embedding-3-small", "input": ["a"] * 512}
+    assert latency_kind(small) != latency_kind(large)
+
+
+def test_mixed_traffic_does_not_read_as_overload():
+    limiter = AdaptiveConcurrencyLimiter(16)
+    quick, slow = latency_kind(chat(200)), latency_kind(chat(200, n=4, prompt="x" * 8000))
+    for _ in range(50):
+        for kind, latency in ((quick, 0.3), (slow, 4.0)):
+            limiter.in_flight += 1
+            limiter.release(kind, latency)
+    assert limiter.limit == 16